@@ -0,0 +1,242 @@
+"""
+Keystroke latency benchmark, replaying scripted key sequences on synthetic calendars.
+
+Generates calendars of the given sizes (cached between runs), then drives Calamity through command_tree.ROOT with
+getch and questionary replaced by the script, rendering into an in-memory buffer. The latency of a command is the
+time from its first key to the next read of a key, i.e. dispatch plus the redraw. The keys of a command arrive at
+once, as a burst: the frame is only drawn after the last one. --think adds a pause before each command, in which the
+background work (prefetching) can run, as it would between the keystrokes of a person. Prints percentiles per scenario;
+--save writes them to a JSON file, which --compare reads to show the change against an earlier run (or release).
+
+    python benchmarks/keystrokes.py [--sizes 1000 100000 1000000] [--rounds 20] [--think 100] [--save out.json]
+                                    [--compare old.json]
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('COLUMNS', '160')
+os.environ.setdefault('LINES', '50')  # 33 days
+
+import questionary
+import sqlalchemy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # run from a checkout
+from calamity_calendar import app, colors, database, display
+from calamity_calendar.database import Event
+
+CACHE = os.path.join(tempfile.gettempdir(), 'calamity-benchmarks')
+EVENTS_PER_DAY = 8
+WORDS = ['meeting', 'gym', 'dentist', 'lecture', 'groceries', 'laundry', 'standup', 'review', 'call', 'homework',
+         'lunch', 'flight', 'haircut', 'rent', 'practice', 'dinner']
+TYPES = ['appointment'] * 5 + ['task'] * 2 + ['chore'] * 3
+BATCH_SIZE = 10000
+
+# each scenario is a list of commands: (keys, answers to the prompts the command opens)
+# the commands of a scenario are repeated for every round, on the calendar left by the previous round
+SCENARIOS = {
+    'navigation': [('j', []), ('j', []), ('k', []), ('w', []), ('b', []), ('l', []), ('h', []), ('>', []),
+                   ('<', []), ('zj', []), ('zk', []), ('\t', []), (' ', []), ('gg', [])],
+    'search': [('/', ['meeting']), ('n', []), ('n', []), ('N', []), ('*', []), ('#', []), ('gg', [])],
+    'group edit': [('gg', []), ('1', []), ('g;', []), ('g,', []), ('g+', []), ('g-', [])],
+    'edit': [('gg', []), ('1', []), (';', []), ('+', []), ('-', []), ('d', ['edited']), ('~', []), ('~', [])],
+    'undo': [('gg', []), ('1', []), (';', []), ('g;', []), ('u', []), ('u', []), ('\x12', []), ('\x12', [])],
+    'repeat': [('gg', []), ('1', []), ('+', []), ('.', []), ('.', []), ('-', []), ('.', []), ('.', [])],
+    'overview': [('zo', []), ('j', []), ('w', []), ('>', []), ('>', []), ('<', []), ('zo', [])],
+    'free slot': [('gg', []), ('f', ['60 0900-1700 weekdays']), ('f', ['60 0900-1700 weekdays']),
+                  ('f', ['240 0800-1800 weekdays'])],
+    'key repeat': [('j' * 20, []), ('k' * 20, []), ('w' * 10, []), ('b' * 10, []), ('l' * 10, [])],
+}
+
+
+# SYNTHETIC CALENDARS
+def random_event(rng, date):
+    kind = rng.choice(TYPES)
+    event = {'date': date, 'description': f"{rng.choice(WORDS)} {rng.randrange(1000)}", 'code': '',
+             'color': rng.choice(colors.COLORS), 'recurrence_parent': rng.getrandbits(32), 'type': kind,
+             'start_time': None, 'end_time': None}
+    if kind == 'appointment':
+        start = rng.randrange(7 * 4, 20 * 4) * 15
+        event.update(start_time=start, end_time=start + rng.choice([30, 60, 60, 90, 120]))
+    elif kind == 'task':
+        event['code'] = f"{rng.choice(['CS', 'MA', 'PH'])}{rng.randrange(100, 400)}"
+    return event
+
+
+def generate(path, n_events, seed=0):
+    """
+    A calendar of about n_events events (counting rule occurrences) around today, EVENTS_PER_DAY a day:
+    60% single events, 30% in groups of copies (repeated by hand or pasted), 10% occurrences of rules.
+    """
+    rng = random.Random(seed)
+    n_days = max(n_events // EVENTS_PER_DAY, 30)
+    first = datetime.date.today().toordinal() - n_days // 2
+    database.open_calendar(path)
+    session = database.Session()
+    events, rules = [], []
+    n = 0
+    while n < n_events:
+        date = first + rng.randrange(n_days)
+        event = random_event(rng, date)
+        kind = rng.random()
+        if kind < 0.6:
+            events.append(event)
+            n += 1
+        elif kind < 0.9:
+            period, count = rng.choice([1, 7, 7, 14]), rng.randrange(2, 12)
+            events += [dict(event, date=date + i * period) for i in range(count)]
+            n += count
+        else:
+            period, count = rng.choice([1, 7, 7, 14]), rng.randrange(10, 52)
+            exceptions = sorted({date + rng.randrange(count) * period for _ in range(rng.randrange(3))})
+            rules.append(dict(event, period=period, count=count, exceptions=exceptions))
+            n += count
+        if len(events) >= BATCH_SIZE:
+            session.execute(sqlalchemy.insert(Event), events)
+            events = []
+        if len(rules) >= BATCH_SIZE:
+            database.insert_rules(rules, session)
+            rules = []
+    if events:
+        session.execute(sqlalchemy.insert(Event), events)
+    database.insert_rules(rules, session)
+    session.commit()
+    session.close()
+    close_calendar()
+
+
+def close_calendar():
+    # every connection has to be closed for the last one to checkpoint the WAL into the file
+    database.config.commit()
+    database.config.session.close()
+    database.connection.close()
+    database.engine.dispose()
+
+
+def calendar(n_events, seed):
+    # the cached calendar of that size, generated the first time
+    os.makedirs(CACHE, exist_ok=True)
+    path = os.path.join(CACHE, f'events-{n_events}-{seed}.db')
+    if not os.path.exists(path):
+        print(f"Generating a calendar of {n_events} events in {path}...", file=sys.stderr)
+        generate(path + '.partial', n_events, seed)
+        os.replace(path + '.partial', path)
+    return path
+
+
+# REPLAY
+class Done(Exception):
+    pass
+
+
+class Script:
+    """
+    Stands in for getch, pending and questionary: hands out the keys and answers of the commands,
+    timing each command from its first key until the next key is read.
+    """
+
+    def __init__(self, commands, think=0):
+        self.commands = list(commands)
+        self.think = think  # seconds of pause before each command
+        self.keys = []
+        self.answers = []
+        self.started = None
+        self.latencies = []
+
+    def getch(self, timeout=None, idle=None):
+        if not self.keys:
+            if self.started is not None:
+                self.latencies.append(time.perf_counter() - self.started)
+            if not self.commands:
+                raise Done
+            if self.think:
+                time.sleep(self.think)
+            keys, answers = self.commands.pop(0)
+            self.keys, self.answers = list(keys), list(answers)
+            self.started = time.perf_counter()
+        return self.keys.pop(0)
+
+    def pending(self):
+        return bool(self.keys)
+
+    def prompt(self, *args, **kwargs):
+        answer = self.answers.pop(0) if self.answers else ''
+        return type('Question', (), {'ask': lambda question: answer})()
+
+
+def replay(commands, think=0):
+    # run commands on the open calendar, returns the latency of each command in seconds
+    script = Script(commands, think)
+    app.getch, app.pending = script.getch, script.pending
+    questionary.text = questionary.confirm = questionary.path = script.prompt
+    cal = app.Calamity()
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    try:
+        cal.main_loop()
+    except Done:
+        pass
+    finally:
+        sys.stdout = stdout
+        cal.session.close()
+    return script.latencies
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    at = lambda p: latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000
+    return {'n': len(latencies), 'p50': at(50), 'p90': at(90), 'p99': at(99), 'max': latencies[-1] * 1000}
+
+
+def benchmark(n_events, rounds, seed, think=0):
+    # {scenario: percentiles} on a copy of the calendar, as the edit scenarios change it
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'events.db')
+        shutil.copy(calendar(n_events, seed), path)
+        database.open_calendar(path)
+        database.versions.touch_all()  # forget the rows rendered from another calendar
+        display.row_cache.clear()
+        for name, commands in SCENARIOS.items():
+            results[name] = percentiles(replay(commands * rounds, think))
+        close_calendar()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000])
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--think', type=float, default=0, help="milliseconds of pause before each command")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="a JSON file saved by an earlier run")
+    args = parser.parse_args()
+    previous = {}
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+    results = {}
+    print(f"{'events':>8} {'scenario':<12} {'n':>5} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}  (ms)")
+    for n_events in args.sizes:
+        results[str(n_events)] = benchmark(n_events, args.rounds, args.seed, args.think / 1000)
+        for name, stats in results[str(n_events)].items():
+            line = (f"{n_events:>8} {name:<12} {stats['n']:>5} {stats['p50']:>8.2f} {stats['p90']:>8.2f} "
+                    f"{stats['p99']:>8.2f} {stats['max']:>8.2f}")
+            old = previous.get(str(n_events), {}).get(name)
+            if old:
+                line += f"  p50 {stats['p50'] / old['p50']:.2f}x, p90 {stats['p90'] / old['p90']:.2f}x"
+            print(line)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Checks that the queries the application issues use the indexes of the events table, with EXPLAIN QUERY PLAN.
+
+Creates a calendar with open_calendar (so with every migration), records the statements run on the events table by
+the window query, the search seek, the recurrence group operations and the free slot finder, and prints their query
+plans. Exits with status 1 if a statement doesn't search the events table with the index it needs (and, for the
+search, the full-text index).
+
+    python benchmarks/query_plans.py
+"""
+import datetime
+import os
+import sys
+import tempfile
+
+import sqlalchemy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # run from a checkout
+from calamity_calendar import app, database
+
+# the lines every plan of the statements of an operation must contain (the start of a line, then a substring)
+# the search looks the matches up in the full-text index, then their rows by id or by date
+PLANS = {
+    'query_window': [('SEARCH events', 'ix_events_date_type_start_time')],
+    'search': [('SEARCH events', ''), ('SCAN events_fts', 'VIRTUAL TABLE INDEX')],
+    'fetch_group': [('SEARCH events', 'ix_events_recurrence_parent_date')],
+    'update_group': [('SEARCH events', 'ix_events_recurrence_parent_date')],
+    'shift_group': [('SEARCH events', 'ix_events_recurrence_parent_date')],
+    'delete_group': [('SEARCH events', 'ix_events_recurrence_parent_date')],
+    'free_slot': [('SEARCH events', 'ix_events_type_date_start_time_end_time')],
+}
+
+
+def record(operation, table):
+    # runs operation(session) and returns the statements it executed on the table, with their parameters
+    recorded = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if f' {table} ' in f' {statement} '.replace('\n', ' ') and not statement.startswith('INSERT'):
+            recorded.append((statement, parameters))
+
+    sqlalchemy.event.listen(database.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        with database.Session() as session:
+            operation(session)
+            session.rollback()
+    finally:
+        sqlalchemy.event.remove(database.engine, 'before_cursor_execute', before_cursor_execute)
+    return recorded
+
+
+def query_plan(statement, parameters):
+    with database.engine.connect() as connection:
+        rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    return [row[-1] for row in rows]
+
+
+def search(session, date, text):
+    # the seek of / (and n), from a day without events: the matches of the day, then the next date with a match
+    cal = app.Calamity()
+    cal.session = session
+    cal.chosen_date = date
+    cal.matching = database.search_matching(text), database.search_matching(text, database.Rule)
+    cal.search_motion()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        database.open_calendar(os.path.join(directory, 'events.db'))
+        today = datetime.date.today().toordinal()
+        with database.Session() as session:
+            session.add_all(database.Event(date=today + i, type='appointment', start_time=600, end_time=660,
+                                           description=f'gym {i}', recurrence_parent=1) for i in range(10))
+            session.commit()
+        operations = {
+            'query_window': lambda session: database.query_window(today, 30, session),
+            'search': lambda session: search(session, today - 5, 'gym'),
+            'fetch_group': lambda session: database.fetch_group(1, session),
+            'update_group': lambda session: database.update_group(1, {'description': 'group'}, session),
+            'shift_group': lambda session: database.shift_group(1, 7, session),
+            'delete_group': lambda session: database.delete_group(1, session, from_date=today + 5),
+            'free_slot': lambda session: database.fetch_intervals(today, today + 30, session),
+        }
+        failures = []
+        for name, operation in operations.items():
+            table = 'events_fts' if name == 'search' else 'events'  # not the rows of the days it goes through
+            statements = record(operation, table)
+            if not statements:
+                failures.append(f'{name} ran no statement on the {table} table')
+            for statement, parameters in statements:
+                plan = query_plan(statement, parameters)
+                print(f"{name}: {' '.join(statement.split())}")
+                for line in plan:
+                    print('    ' + line)
+                for start, index in PLANS[name]:
+                    if not any(line.startswith(start) and index in line for line in plan):
+                        failures.append(f'{name} does not use {index or start}: {" ".join(statement.split())}')
+        database.connection.close()
+        database.config.session.close()
+        database.engine.dispose()
+    for failure in failures:
+        print('FAIL:', failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Startup time benchmark, based on python -X importtime.
+
+Measures the import time of calamity_calendar and of the application module, the time it takes open_calendar to
+open (and create) a calendar, and the path of the calamity command on a calendar of N_EVENTS events: the time to the
+first frame (drawn with sqlite3), and the time until the application has opened the calendar. Exits with status 1 if
+a module that should be imported lazily shows up at startup, or if a measurement is over its budget.
+
+    python benchmarks/startup.py [--runs 5]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+# modules that must not be imported by the given module (they are imported when first needed)
+LAZY = {
+    'calamity_calendar': ('sqlalchemy', 'questionary', 'curses', 'fire'),
+    'calamity_calendar.app': ('questionary', 'curses', 'fire'),
+    'calamity_calendar.first_frame': ('sqlalchemy', 'questionary', 'curses', 'fire'),
+}
+# budgets in milliseconds (best of the runs)
+# the 100 ms target is the first frame, drawn with sqlite3; the application (SQLAlchemy and the ORM) follows it in
+# about 450-500 ms, and its budget is kept just above that so that a slower import shows up
+BUDGETS = {
+    'calamity_calendar': 5,
+    'open_calendar': 100,
+    'first frame': 100,
+    'application': 520,
+}
+N_EVENTS = 1000
+# the calamity command (see calamity_calendar.run), in ms after the interpreter's own startup
+STARTUP_CODE = """
+import io, sys, time
+start = time.perf_counter()
+stdout, sys.stdout = sys.stdout, io.StringIO()  # the frame
+from calamity_calendar import first_frame
+first_frame.show({path!r})
+first = time.perf_counter()
+from calamity_calendar import app
+app.database.open_calendar({path!r})
+sys.stdout = stdout
+print((first - start) * 1000, (time.perf_counter() - start) * 1000)
+"""
+# a calendar of N_EVENTS events around today
+GENERATE_CODE = """
+import datetime, sqlalchemy
+from calamity_calendar import database
+database.open_calendar({path!r})
+today = datetime.date.today().toordinal()
+with database.Session() as session:
+    session.execute(sqlalchemy.insert(database.Event), [
+        {{'date': today - {n} // 16 + i // 8, 'description': f'event {{i}}', 'color': 'cyan', 'recurrence_parent': i,
+          'type': ['appointment', 'task', 'chore'][i % 3], 'start_time': 600, 'end_time': 660, 'code': 'CS101'}}
+        for i in range({n})])
+    session.commit()
+database.config.commit()
+"""
+
+
+
+def import_times(module):
+    # {module: cumulative import time in ms} for a fresh interpreter importing module
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def open_calendar_time():
+    # ms to open a new calendar, measured in a fresh interpreter after the imports
+    with tempfile.TemporaryDirectory() as directory:
+        code = ("import time; from calamity_calendar import database; start = time.perf_counter(); "
+                f"database.open_calendar({os.path.join(directory, 'events.db')!r}); "
+                "print((time.perf_counter() - start) * 1000)")
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        return float(result.stdout)
+
+
+def startup_times(path):
+    # (ms to the first frame, ms until the application has opened the calendar) in a fresh interpreter
+    result = subprocess.run([sys.executable, '-c', STARTUP_CODE.format(path=path)],
+                            capture_output=True, text=True, check=True)
+    return tuple(map(float, result.stdout.split()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    failures = []
+    results = {}
+    for module, lazy in LAZY.items():
+        runs = [import_times(module) for _ in range(args.runs)]
+        results[module] = min(times[module] for times in runs)
+        failures += [f'{module} imports {name}' for name in lazy if name in runs[0]]
+    results['open_calendar'] = min(open_calendar_time() for _ in range(args.runs))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'events.db')
+        subprocess.run([sys.executable, '-c', GENERATE_CODE.format(path=path, n=N_EVENTS)], check=True)
+        runs = [startup_times(path) for _ in range(args.runs)]
+    results['first frame'] = min(first for first, _ in runs)
+    results['application'] = min(opened for _, opened in runs)
+    for name, ms in results.items():
+        budget = BUDGETS.get(name)
+        print(f'{name:<30} {ms:8.1f} ms' + (f'   (budget {budget} ms)' if budget else ''))
+        if budget and ms > budget:
+            failures.append(f'{name} took {ms:.1f} ms, over the budget of {budget} ms')
+    for failure in failures:
+        print('FAIL:', failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
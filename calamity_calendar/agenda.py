@@ -0,0 +1,229 @@
+"""
+The headless, read-only commands, for scripts and status bars:
+    calamity agenda [--days N] [--json]
+    calamity query [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--type TYPE] [--search TEXT] [--json]
+    calamity report [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--by color,code,type,group] [--per week|month|all] [--csv]
+They only use sqlite3 (neither SQLAlchemy nor the application is imported), so they answer in a few milliseconds.
+The queries they share with the application live here too.
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import re
+import sqlite3
+import sys
+
+# the database file lives in ~/.local/share/calamity/events.db by default
+DB_PATH = os.path.join(os.path.expanduser('~'), '.local', 'share', 'calamity', 'events.db')
+
+# Expands the rules into one row per occurrence in [:from_date, :to_date), with the columns of an EventView.
+# The recursion starts at the first occurrence in the range, so the cost depends on the range, not on the rules.
+OCCURRENCES_SQL = """
+WITH RECURSIVE occurrences (rule_id, date, period, last_date) AS (
+    SELECT id, date + MAX(0, (:from_date - date + period - 1) / period) * period, period, date + (count - 1) * period
+    FROM rules WHERE date < :to_date AND date + (count - 1) * period >= :from_date
+    UNION ALL
+    SELECT rule_id, date + period, period, last_date FROM occurrences
+    WHERE date + period <= last_date AND date + period < :to_date
+)
+SELECT NULL AS id, occurrences.date, description, color, recurrence_parent, type, start_time, end_time, code,
+       rules.id AS rule_id
+FROM occurrences JOIN rules ON rules.id = occurrences.rule_id
+WHERE occurrences.date < :to_date AND NOT EXISTS (
+    SELECT 1 FROM rule_exceptions WHERE rule_id = rules.id AND rule_exceptions.date = occurrences.date)
+"""
+
+# the events in [:from_date, :to_date), with the same columns as OCCURRENCES_SQL
+EVENTS_SQL = """
+SELECT id, date, description, color, recurrence_parent, type, start_time, end_time, code, NULL AS rule_id
+FROM events WHERE date >= :from_date AND date < :to_date
+"""
+
+TYPE_ORDER = {'appointment': 0, 'task': 1, 'chore': 2}
+
+# the columns a report can be grouped by: (the grouping expression, the one shown), and their widths in a table
+REPORT_COLUMNS = {'color': ('color', 'color'), 'code': ("COALESCE(code, '')", "COALESCE(code, '')"),
+                  'type': ('type', 'type'), 'group': ('recurrence_parent', 'MIN(description)')}
+REPORT_WIDTHS = {'period': 8, 'color': 8, 'code': 8, 'type': 11, 'group': 24, 'events': 7, 'hours': 8}
+# a week is named after its monday (ordinal 1 is a monday), a month is YYYY-MM (ordinal 1 is julian day 1721425.5)
+REPORT_PERIODS = {'week': 'date - (date - 1) % 7', 'month': "strftime('%Y-%m', date + 1721424.5)", 'all': "'all'"}
+
+
+def fts_query(search):
+    # "quoted words" are matched as a phrase, other words as prefixes; all of them must match
+    terms = re.findall(r'"[^"]*"|[^\s"]+', search)
+    terms = [term if term.startswith('"') else '"' + term + '"*' for term in terms if term.strip('"')]
+    return ' '.join(terms)
+
+
+def connect(path=DB_PATH):
+    # read-only: never takes the write lock, and never waits for the editor (WAL mode)
+    if not os.path.exists(path):
+        print(f"There is no calendar at {path}.", file=sys.stderr)
+        exit(1)
+    connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+
+def fetch(connection, from_date, to_date, kind=None, search=None):
+    # the events and rule occurrences in [from_date, to_date), by date, type and start time
+    params = {'from_date': from_date, 'to_date': to_date, 'type': kind, 'query': fts_query(search or '')}
+    events, occurrences = EVENTS_SQL, OCCURRENCES_SQL
+    if kind:
+        events += " AND type = :type"
+        occurrences += " AND rules.type = :type"
+    if params['query']:
+        events += " AND id IN (SELECT rowid FROM events_fts WHERE events_fts MATCH :query)"
+        occurrences += " AND rules.id IN (SELECT rowid FROM rules_fts WHERE rules_fts MATCH :query)"
+    # the WITH clause has to come first in a compound select, which can't be ordered by an expression
+    rows = connection.execute(f"{occurrences} UNION ALL {events}", params).fetchall()
+    return sorted(rows, key=lambda row: (row['date'], TYPE_ORDER.get(row['type'], 3), row['start_time'] or 0))
+
+
+def report_sql(by, period):
+    """
+    The number of events and the minutes booked in appointments in [:from_date, :to_date), rule occurrences included,
+    per period and per the columns of by. A single GROUP BY reads the events: none of them is loaded.
+    """
+    shown = ''.join(f", {REPORT_COLUMNS[column][1]}" for column in by)
+    grouped = ', '.join([REPORT_PERIODS[period]] + [REPORT_COLUMNS[column][0] for column in by])
+    return f"""
+        SELECT {REPORT_PERIODS[period]}{shown}, COUNT(*),
+               COALESCE(SUM(CASE WHEN type = 'appointment' THEN end_time - start_time END), 0) AS minutes
+        FROM (SELECT date, description, color, recurrence_parent, type, start_time, end_time, code FROM events
+              WHERE date >= :from_date AND date < :to_date
+              UNION ALL
+              SELECT date, description, color, recurrence_parent, type, start_time, end_time, code
+              FROM ({OCCURRENCES_SQL}))
+        GROUP BY {grouped}
+        ORDER BY 1, minutes DESC"""
+
+
+def parse_report(text):
+    # 'color code week' into (['color', 'code'], 'week'): the columns to group by (color by default) and the period
+    by, period = [], 'week'
+    for word in text.replace(',', ' ').split():
+        if word in REPORT_PERIODS:
+            period = word
+        elif word in REPORT_COLUMNS and word not in by:
+            by.append(word)
+        else:
+            raise ValueError(word)
+    return by or ['color'], period
+
+
+def report(execute, from_date, to_date, by, period):
+    # yields the rows of the report as (period, *columns, events, minutes), as the database returns them
+    for row in execute(report_sql(by, period), {'from_date': from_date, 'to_date': to_date}):
+        row = tuple(row)
+        if period == 'week':
+            year, week, _ = datetime.date.fromordinal(row[0]).isocalendar()
+            row = (f"{year}-W{week:02}",) + row[1:]
+        yield row
+
+
+def report_table(rows, by):
+    # yields the lines of the report as a table, ending with the totals
+    columns = ['period', *by, 'events', 'hours']
+    line = lambda values: ' '.join(f"{str(value)[:REPORT_WIDTHS[column]]:<{REPORT_WIDTHS[column]}}"
+                                   if column not in ('events', 'hours') else f"{value:>{REPORT_WIDTHS[column]}}"
+                                   for column, value in zip(columns, values))
+    yield line(columns)
+    n_events = minutes = 0
+    for row in rows:
+        n_events, minutes = n_events + row[-2], minutes + row[-1]
+        yield line(row[:-1] + (f"{row[-1] / 60:.1f}",))
+    yield line(['total'] + [''] * len(by) + [n_events, f"{minutes / 60:.1f}"])
+
+
+def format_time(minutes):
+    return f"{minutes // 60:02}:{minutes % 60:02}"
+
+
+def to_dict(row):
+    date = datetime.date.fromordinal(row['date'])
+    timed = row['start_time'] is not None and row['end_time'] is not None
+    return {'date': date.isoformat(), 'type': row['type'],
+            'start': format_time(row['start_time']) if timed else None,
+            'end': format_time(row['end_time']) if timed else None,
+            'description': row['description'], 'code': row['code'], 'color': row['color'],
+            'group': row['recurrence_parent']}
+
+
+def to_line(row):
+    event = to_dict(row)
+    when = f"{event['start']}-{event['end']}" if event['start'] else event['type']
+    return f"{event['date']} {when:<11} {event['description']}"
+
+
+def parse_date(date):
+    try:
+        return datetime.date.fromisoformat(date).toordinal()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{date!r} is not a YYYY-MM-DD date")
+
+
+def main(argv):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--calendar', default=DB_PATH, help="the calendar file")
+    common.add_argument('--json', action='store_true', help="print a JSON list instead of one line per event")
+    parser = argparse.ArgumentParser(prog='calamity')
+    commands = parser.add_subparsers(dest='command', required=True)
+    agenda = commands.add_parser('agenda', parents=[common], help="the events of today (and the next days)")
+    agenda.add_argument('--days', type=int, default=1)
+    query = commands.add_parser('query', parents=[common], help="the events in a date range")
+    query.add_argument('--from', dest='from_date', type=parse_date, help="YYYY-MM-DD, today by default")
+    query.add_argument('--to', dest='to_date', type=parse_date, help="YYYY-MM-DD (inclusive), --from by default")
+    query.add_argument('--type', choices=['appointment', 'task', 'chore'])
+    query.add_argument('--search', help="words in the description or code")
+    report_ = commands.add_parser('report', parents=[common], help="the time booked per week or month, and per color, "
+                                                                   "code, type or group")
+    report_.add_argument('--from', dest='from_date', type=parse_date, help="YYYY-MM-DD, January 1 by default")
+    report_.add_argument('--to', dest='to_date', type=parse_date, help="YYYY-MM-DD (inclusive), today by default")
+    report_.add_argument('--by', default='color', help="comma separated columns: color, code, type, group")
+    report_.add_argument('--per', choices=list(REPORT_PERIODS), default='week')
+    report_.add_argument('--csv', action='store_true', help="print CSV instead of a table")
+    args = parser.parse_args(argv)
+    if args.command == 'report':
+        return main_report(args)
+
+    today = datetime.date.today().toordinal()
+    if args.command == 'agenda':
+        from_date, to_date, kind, search = today, today + args.days, None, None
+    else:
+        from_date = args.from_date if args.from_date is not None else today
+        to_date = (args.to_date if args.to_date is not None else from_date) + 1
+        kind, search = args.type, args.search
+    rows = fetch(connect(args.calendar), from_date, to_date, kind, search)
+    if args.json:
+        json.dump([to_dict(row) for row in rows], sys.stdout)
+        print()
+    else:
+        for row in rows:
+            print(to_line(row))
+
+
+def main_report(args):
+    # the rows are printed as SQLite returns them
+    today = datetime.date.today()
+    from_date = args.from_date if args.from_date is not None else today.replace(month=1, day=1).toordinal()
+    to_date = (args.to_date if args.to_date is not None else today.toordinal()) + 1
+    try:
+        by, period = parse_report(f"{args.by} {args.per}")
+    except ValueError as error:
+        print(f"Can't group a report by {error}: use {', '.join(REPORT_COLUMNS)}.", file=sys.stderr)
+        exit(2)
+    rows = report(connect(args.calendar).execute, from_date, to_date, by, period)
+    if args.json:
+        json.dump([dict(zip(['period', *by, 'events', 'minutes'], row)) for row in rows], sys.stdout)
+        print()
+    elif args.csv:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(['period', *by, 'events', 'minutes'])
+        writer.writerows(rows)
+    else:
+        for line in report_table(rows, by):
+            print(line)
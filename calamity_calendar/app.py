@@ -0,0 +1,815 @@
+import os
+import types
+import string
+import datetime
+import signal
+import resource
+
+import sqlalchemy
+
+# questionary (and validators, which use it) and pager (curses) are slow to import, so they are imported when needed
+from calamity_calendar import display, database, colors, help, dateutils, command_tree, profiler
+from calamity_calendar.database import Event
+from calamity_calendar.getch import getch, pending, typeahead
+
+READ_ONLY_MESSAGE = "Read-only: the calendar was opened with --view, or was locked by another process."
+BUSY_MESSAGE = "The calendar is busy (locked by another process), try again."
+REFRESH_INTERVAL = 0.5  # seconds between checks for changes made by other processes
+
+
+class Calamity:
+
+    def __init__(self):
+        self.session = None
+        self.appointments = []
+        self.tasks = []
+        self.chores = []
+        self.events = []
+        self.window = {}  # {date: (appointments, tasks, chores)} for the visible days, loaded once per frame
+        self.today = datetime.date.today().toordinal()
+        self._chosen_date = self.today
+        self._chosen_event = None
+        # undo/redo
+        self.last_action = None  # repeated by (.)
+        self.backup = None  # the running (or last finished) backup, until its outcome has been shown
+        # search
+        self.search = ''
+        self.matching = None
+        self.overview = False  # the year overview instead of the days
+        # free slot finder
+        self.free_slot_query = '60 0900-1700 weekdays'
+        self.report_query = 'color week'
+        self.free_slot = None  # (date, start_time, end_time) of the last free slot found
+        # message
+        self.welcomed = False
+        self.error = None
+        self.message = ''
+        # window
+        self.from_date = self.today
+        # yank/paste
+        self.yank_list = []
+        self.yank_rules = []
+        self.yank_date = self.today
+
+    # define a setter for chosen_event (we defined the getter elsewhere)
+    @property
+    def chosen_event(self):
+        return self._chosen_event
+
+    @chosen_event.setter
+    def chosen_event(self, event):
+        self._chosen_event = event
+        if event and event.date != self.chosen_date:
+            self.chosen_date = event.date  # trigger date setter
+
+    @property
+    def chosen_record(self):
+        # the Event instance of the chosen event, only loaded to modify it
+        # an occurrence of a rule is materialized into an event of its own (so the edit only applies to it)
+        if self.chosen_event.rule_id is not None:
+            self.chosen_event = database.EventView.from_event(database.materialize(self.chosen_event, self.session))
+        return self.session.get(Event, self.chosen_event.id)
+
+    @property
+    def chosen_date(self):
+        return self._chosen_date
+
+    @chosen_date.setter
+    def chosen_date(self, date):
+        # save the idx of the old event
+        if self.chosen_event and self.chosen_event.date != date:
+            old_type = self.chosen_event.type
+            old_chore_idx, old_task_idx = self.chore_idx, self.task_idx,
+            old_appt_start, old_appt_end = self.chosen_event.start_time, self.chosen_event.end_time
+        self.fix_window()
+        # set the chosen date and re-fetch the list of events (from the window if it is loaded)
+        self._chosen_date = date
+        if date in self.window:
+            self.appointments, self.tasks, self.chores = self.window[date]
+        else:
+            self.appointments, self.tasks, self.chores = database.fetch_events(self.chosen_date, session=self.session)
+        self.events = self.appointments + self.tasks + self.chores
+        # try to keep the same chore_idx/appt_idx/task_idx if possible
+        if self.chosen_event and self.chosen_event.date != date:
+            if old_type == 'chore':
+                self.chore_idx = old_chore_idx
+            elif old_type == 'task':
+                self.task_idx = old_task_idx
+            elif old_type == 'appointment':
+                self.chosen_event = None
+                for event in self.appointments:
+                    # set if we start before or during the event (i.e. start <= end)
+                    # if still None, set
+                    if event.start_time < old_appt_end:
+                        self.chosen_event = event
+                    elif self.chosen_event is None:
+                        self.chosen_event = event
+            else:
+                self.chosen_event = None
+
+    @property
+    def chosen_event_idx(self):
+        # get position of chosen event in events
+        if self.chosen_event is None:
+            return None
+        for i, event in enumerate(self.events):
+            if event.key == self.chosen_event.key:
+                return i
+        raise RuntimeError('Chosen event not in events')
+
+    @chosen_event_idx.setter
+    def chosen_event_idx(self, idx):
+        self.chosen_event = self.events[idx] if (idx is not None and 0 <= idx < len(self.events)) else None
+
+    @property
+    def task_idx(self):
+        if not self.chosen_event or self.chosen_event.type != 'task':
+            return None
+        return self.chosen_event_idx - len(self.appointments)
+
+    @task_idx.setter
+    def task_idx(self, idx):
+        self.chosen_event_idx = len(self.appointments) + idx if idx < len(self.tasks) else (
+                len(self.appointments) + len(self.tasks) - 1) if self.tasks else None
+
+    @property
+    def appointment_idx(self):
+        if not self.chosen_event or self.chosen_event.type != 'appointment':
+            return None
+        return self.chosen_event_idx
+
+    @appointment_idx.setter
+    def appointment_idx(self, idx):
+        self.chosen_event_idx = idx if idx < len(self.appointments) else len(
+            self.appointments) - 1 if self.appointments else None
+
+    @property
+    def chore_idx(self):
+        if not self.chosen_event or self.chosen_event.type != 'chore':
+            return None
+        return self.chosen_event_idx - len(self.appointments) - len(self.tasks)
+
+    @chore_idx.setter
+    def chore_idx(self, idx):
+        zero = len(self.appointments) + len(self.tasks)
+        self.chosen_event_idx = zero + idx if idx < len(self.chores) else (
+                zero + len(self.chores) - 1) if self.chores else None
+
+    def idx_of(self, event):
+        # get the index of event in the list of events
+        for i, e in enumerate(self.events):
+            if e.key == event.key:
+                return i
+        raise RuntimeError('Event not in events')
+
+    def fix_window(self):
+        # scroll the window so that the chosen date is visible
+        if self.from_date + display.get_num_days() <= self.chosen_date:
+            self.from_date = self.chosen_date - display.get_num_days() + 1
+        elif self.chosen_date < self.from_date:
+            self.from_date = self.chosen_date
+
+    def load_window(self):
+        # fetch all the visible events with one query
+        self.window = database.fetch_window(self.from_date, display.get_num_days(), self.session)
+
+    def choose_event(self, event):
+        self.chosen_event = event
+
+    def main_loop(self):
+        self.session = database.Session(bind=database.connection)
+        if database.read_only:
+            self.message = READ_ONLY_MESSAGE
+        node = command_tree.ROOT
+        while True:
+            # display, once the keys typed ahead (a held key, a paste) have all been dispatched
+            if pending():
+                self.refresh()
+            else:
+                if self.backup is not None:
+                    self.message = self.message or self.backup.status()
+                    if not self.backup.is_alive():
+                        self.backup = None
+                if isinstance(node, command_tree.TrieNode) and database.config['show_help']:
+                    self.message = self.message or node.message
+                self.display()
+            # get the next character and move to the corresponding node
+            # while waiting, poll for changes saved by other instances of calamity, which are shown right away
+            with database.prefetching():
+                c = getch(timeout=REFRESH_INTERVAL, idle=self.idle)
+            if c == 'REFRESH':
+                continue  # redraw, keeping the keys typed so far (e.g. g, waiting for the rest of the command)
+            if c not in node:
+                node = command_tree.ROOT
+            if c in node:
+                node = node[c]
+                profiler.key(c)
+                if isinstance(node, types.FunctionType):
+                    try:
+                        with profiler.stage('dispatch'), typeahead():
+                            node(self)
+                    except sqlalchemy.exc.OperationalError as error:
+                        # another process held the write lock for longer than database.BUSY_TIMEOUT
+                        if 'database is locked' not in str(error):
+                            raise
+                        self.session.rollback()
+                        database.config.session.rollback()
+                        database.versions.touch_all()  # the rows drawn may have been changed by the rolled back edit
+                        self.message = BUSY_MESSAGE
+                    node = command_tree.ROOT
+
+    def idle(self):
+        # called while waiting for a key, returns True to redraw: the calendar changed, or to show backup progress
+        return database.watcher.check() or self.backup is not None
+
+    def refresh(self, load_window=False):
+        # refresh data (the visible events are only loaded to draw a frame)
+        with profiler.stage('refresh'):
+            database.watcher.check()  # another instance may have saved changes since the last frame
+            if self.chosen_event:
+                self.chosen_event = database.refetch(self.chosen_event, self.session)  # follow event to a new date
+            self.fix_window()
+            if load_window:
+                self.load_window()
+            self.chosen_date = self.chosen_date  # update list of events on that date
+
+    def display(self):
+        self.refresh(load_window=True)
+        display.show_all(self)
+        self.window = {}  # the next command may change the session, so the window is only valid for this frame
+        self.message = ''
+        if not self.overview:
+            # while waiting for the next key, load the windows before and after this one
+            n_days = display.get_num_days()
+            database.prefetch([(self.from_date + n_days, n_days), (self.from_date - n_days, n_days)])
+        with profiler.stage('refresh'):
+            self.evict()
+        overlay = profiler.end_frame()
+        if overlay:
+            display.show_overlay(overlay)
+
+    def evict(self):
+        # keep the session's identity map bounded: forget the events outside the window (plus a margin)
+        # Calamity only holds EventViews between commands, and forgotten events are reloaded when needed;
+        # the undo log is written by triggers in the database, so it doesn't depend on the objects in the session
+        first = self.from_date - database.config['session_margin']
+        last = self.from_date + display.get_num_days() + database.config['session_margin']
+        for obj in list(self.session.identity_map.values()):
+            state = sqlalchemy.inspect(obj)
+            date = state.dict.get('date')  # None if expired, reading obj.date would reload it
+            if not state.modified and (date is None or not first <= date < last):
+                self.session.expunge(obj)
+
+    def toggle_overview(self):
+        # leaving the overview jumps to the chosen day
+        self.overview = not self.overview
+        if not self.overview:
+            self.from_date = self.chosen_date - display.get_num_days() // 2
+
+    def show_memory(self):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024  # kilobytes on linux
+        self.message = (f"Memory: {len(self.session.identity_map)} events in the session "
+                        f"(window ± {database.config['session_margin']} days), "
+                        f"{len(database.day_cache)} days and {len(display.row_cache)} rendered rows cached, "
+                        f"peak {peak} MB")
+
+    def redraw(self, signum=None, frame=None):
+        display.invalidate()  # the terminal was resized
+        self.load_window()
+        display.show_all(self)
+        self.window = {}
+
+    # MISCELLANEOUS COMMANDS
+    def show_help(self):
+        from calamity_calendar import pager
+        pager.pager(help.HELP_TEXT, center=True)
+        display.invalidate()
+
+    def quit(self, save=True, ask=False):
+        import questionary
+        ask = ask and not database.read_only  # a viewer has no changes to discard
+        if not save or (ask and questionary.confirm("Quit without saving (undo all changes)?", default=False).ask()):
+            self.session.rollback()
+            if not database.read_only:
+                database.discard_steps(self.session)  # the changes were saved as they were made
+            database.config.rollback()
+            print("Changes discarded.")
+        elif not database.read_only:
+            database.release_steps(self.session)
+        self.session.commit()
+        database.config.commit()
+        print(colors.CLEAR_TO_END + colors.CURSOR_ON + colors.WRAP_ON + colors.RESET, end='', flush=True)
+        exit()
+
+    # quit on signal
+    def sig_quit(self, signum, frame):
+        self.quit()
+
+    def sig_quit_without_saving(self, signum, frame):
+        self.quit(save=False)
+
+    def make_backup(self):
+        import questionary
+        from calamity_calendar import backup
+        if self.backup is not None and self.backup.is_alive():
+            return
+        display.invalidate()  # the prompt writes to the terminal
+        location = questionary.path(message="Backup database location: ", only_directories=True,
+                                    default=database.config['backup_location']).ask()
+        if not location:
+            return
+        database.config['backup_location'] = location
+        # back up on a background thread, main_loop shows the progress
+        self.backup = backup.Backup(database.calendar_path, os.path.expanduser(location),
+                                    snapshots=database.config['backup_snapshots'])
+        self.backup.start()
+
+    def yank(self, group=False):
+        if not self.chosen_event:
+            return
+        self.yank_date = self.chosen_date
+        yank_list = [self.chosen_event]
+        if group:
+            yank_list = database.fetch_group(self.chosen_event.recurrence_parent, self.session)
+        self.yank_list = [event.to_dict() for event in yank_list]
+        self.yank_rules = database.fetch_group_rules(self.chosen_event.recurrence_parent, self.session) if group else []
+
+    def paste(self, group=None):
+        # self.yank is a list of events serialized as dictionaries
+        delta = self.chosen_date - self.yank_date
+        rows = []
+        for event_dict in self.yank_list:
+            new_dict = event_dict.copy()
+            del new_dict['id']  # don't want to copy the old event's id
+            new_dict['date'] += delta
+            rows.append(new_dict)
+        # insert all the events with one statement, getting their ids back
+        for new_id, new_dict in zip(database.insert_events(rows, self.session), rows):
+            if new_dict['date'] == self.chosen_date:
+                self.chosen_event = database.EventView(id=new_id, **new_dict)
+        rules = []
+        for rule_dict in self.yank_rules:
+            new_dict = rule_dict.copy()
+            del new_dict['id']
+            new_dict['date'] += delta
+            new_dict['exceptions'] = [date + delta for date in rule_dict['exceptions']]
+            rules.append(new_dict)
+        database.insert_rules(rules, self.session)
+
+    def separate(self, group=None):
+        if self.chosen_event is None:
+            return
+        self.chosen_record.recurrence_parent = database.Event.random_group_id()
+
+    # UNDO/REDO HISTORY
+    def undo(self, redo=False):
+        if database.read_only:
+            self.message = READ_ONLY_MESSAGE
+            return
+        step = database.undo_step(self.session, redo=redo)
+        if step is None:
+            return
+        self.session.commit()
+        self.chosen_event = None  # the chosen event may have been deleted, so we need to reset it to avoid errors
+        self.chosen_date = step.date  # go back to where the edit was made
+        self.chosen_event_idx = step.event_idx  # make sure we have the correct date before setting chosen_event_idx
+
+    def redo(self):
+        self.undo(redo=True)
+
+    def repeat(self):
+        if not self.last_action:
+            return
+        _, _, func, args, kwargs = self.last_action
+        self.checkpoint_wrapper(func, *args, **kwargs)  # replay the last action (checkpointing)
+
+    def checkpoint_wrapper(self, func, *args, **kwargs):
+        # undo record: chosen_date, chosen_event_idx, chosen_function, param (we want to know where we were before we did the action)
+        # undo record:
+        # - chosen_date
+        # - chosen_event_idx   Where were we before we did the action?
+        # - func
+        # - args
+        # - kwargs             What did we do? With what arguments?
+        # to repeat an action using (.) we need to use the new chosen_event/date. However, these can't be retrieved from args.
+        if database.read_only:
+            self.message = READ_ONLY_MESSAGE
+            return
+        undo_record = [self.chosen_date, self.chosen_event_idx, func, args, kwargs]
+        new_kwargs = func(*args, **kwargs)
+        if new_kwargs is not None:
+            assert isinstance(new_kwargs, dict), "checkpoint_wrapper must wrap a function which returns Union[None, dict]"
+            undo_record[-1].update(new_kwargs)  # update kwargs with whatever we get back to make it run more smoothly next time.
+        self.end_undo_step(undo_record)
+        # we need to be able to re-run func. This requires saving the arguments to func. We also want to update kwargs with whatever we get back to make it run more smoothly next time.
+
+    def end_undo_step(self, undo_record):
+        # save the edit to disk (holding the write lock only for the commit) as a step of the undo history
+        self.last_action = undo_record
+        chosen_date, chosen_event_idx, _, _, _ = undo_record
+        database.end_step(chosen_date, chosen_event_idx, database.config['undo_depth'], self.session)
+        self.session.commit()
+
+    # MOTION METHODS
+    def move_horizontal(self, back=False):
+        if not self.events:
+            return
+        if self.chosen_event_idx is not None:
+            self.chosen_event_idx = (self.chosen_event_idx + (-1 if back else 1)) % len(self.events)
+            return
+        if not back:  # move right
+            if self.tasks:
+                self.task_idx = 0
+        elif back:  # move left
+            if self.appointments:
+                self.appointment_idx = len(self.appointments) - 1
+            elif self.chores:
+                self.chore_idx = len(self.chores) - 1
+
+    def move_month(self, back=False):
+        old_date = self.chosen_date
+        self.chosen_date = dateutils.add_month(self.chosen_date, back=back)
+        self.from_date += (self.chosen_date - old_date)
+
+    def cycle_event_by_type(self, event_type):
+        event_list = getattr(self, event_type + 's')
+        if (old_idx := getattr(self, event_type + '_idx')) is not None:
+            setattr(self, event_type + '_idx', (old_idx + 1) % len(event_list))
+        elif event_list:
+            setattr(self, event_type + '_idx', 0)
+
+    def get_search_term(self):
+        import questionary
+        display.invalidate()
+        search = questionary.text("Search: ").ask()
+        if search and search.strip('" '):
+            self.matching = database.search_matching(search), database.search_matching(search, database.Rule)
+        else:
+            self.matching = None
+        self.search_motion()
+
+    def find_free_slot(self):
+        # jump to the first free slot after the last one found (or from now on), and show it
+        import questionary
+        from calamity_calendar.validators import FreeSlotValidator
+        display.invalidate()
+        query = questionary.text("Free slot (minutes [HHMM-HHMM] [weekdays]): ", validate=FreeSlotValidator,
+                                 default=self.free_slot_query).ask()
+        if query is None:
+            return
+        self.free_slot_query = query
+        minutes, first_time, last_time, weekdays = dateutils.parse_free_slot(query)
+        now = datetime.datetime.now()
+        date, time = self.chosen_date, (now.hour * 60 + now.minute if self.chosen_date == self.today else 0)
+        if self.free_slot is not None and self.free_slot[0] == self.chosen_date:
+            date, time = self.free_slot[0], self.free_slot[2]  # the next one
+        slot = database.free_slot(date, time, minutes, first_time, last_time, weekdays, self.session)
+        if slot is None:
+            self.free_slot = None
+            self.message = f"No free slot of {minutes} minutes in the next {database.FREE_SLOT_HORIZON} days"
+            return
+        date, start_time = slot
+        self.free_slot = date, start_time, start_time + minutes
+        self.chosen_date = date
+        self.message = (f"Free: {datetime.date.fromordinal(date).strftime('%a %Y-%m-%d')} "
+                        f"{start_time // 60:02}:{start_time % 60:02}-"
+                        f"{(start_time + minutes) // 60:02}:{(start_time + minutes) % 60:02} (f for the next one)")
+
+    def show_report(self):
+        # the time booked in the year of the chosen date, in the pager
+        import questionary
+        from calamity_calendar import agenda, pager
+        from calamity_calendar.validators import ReportValidator
+        display.invalidate()
+        query = questionary.text("Report by (color code type group) per (week month all): ", validate=ReportValidator,
+                                 default=self.report_query).ask()
+        if query is None:
+            return
+        self.report_query = query
+        by, period = agenda.parse_report(query)
+        year = datetime.date.fromordinal(self.chosen_date).year
+        from_date, to_date = datetime.date(year, 1, 1).toordinal(), datetime.date(year + 1, 1, 1).toordinal()
+        rows = database.report(from_date, to_date, by, period, self.session)
+        pager.pager(f"{year}\n\n" + '\n'.join(agenda.report_table(rows, by)))
+        display.invalidate()
+
+    def warn_overlaps(self):
+        # flag the appointments that the chosen one overlaps
+        self.session.flush()
+        event = database.refetch(self.chosen_event, self.session)
+        if event is None:
+            return
+        others = database.overlapping(event, self.session)
+        if others:
+            self.message = "Overlaps with " + ", ".join(
+                f"{other.description} ({other.start_time // 60:02}:{other.start_time % 60:02}-"
+                f"{other.end_time // 60:02}:{other.end_time % 60:02})" for other in others)
+
+    def get_search_group(self, back=False):
+        if self.chosen_event and self.chosen_event.recurrence_parent:
+            self.matching = (database.Event.recurrence_parent == self.chosen_event.recurrence_parent,
+                             database.Rule.recurrence_parent == self.chosen_event.recurrence_parent)
+            self.search_motion(back=back)
+
+    def search_motion(self, back=False):
+        # back is True if we are searching backwards
+        # matching is a pair of clauses, selecting the matching events and the matching rules, e.g.
+        # e.g. matching = database.search_matching(self.search), database.search_matching(self.search, database.Rule)
+        # e.g. matching = database.Event.recurrence_parent == rp, database.Rule.recurrence_parent == rp
+        # check that there is a search to do
+        if self.matching is None:
+            return
+        matching, matching_rules = self.matching
+        # sqlalchemy objects
+        is_today = database.Event.date == self.chosen_date
+        # next (previous) dates are found by seeking from the chosen date, which can use an index
+        is_after = (database.Event.date < self.chosen_date) if back else (database.Event.date > self.chosen_date)
+        order_by = database.Event.date.desc() if back else database.Event.date
+        next_dates = sqlalchemy.select(database.Event.date).where(matching).order_by(order_by).limit(1)
+        # an occurrence of a rule matches if its rule does
+        rule_ids = set(self.session.scalars(sqlalchemy.select(database.Rule.id).where(matching_rules)))
+
+        def find_match(events, skip=None):
+            todays_matches = set(self.session.scalars(sqlalchemy.select(database.Event.id).where(matching & is_today)))
+            for event in events:
+                if event.key != skip and (event.id in todays_matches or event.rule_id in rule_ids):
+                    self.chosen_event = event
+                    return True
+            return False
+
+        # search for the next occurrence on the same day
+        skip = self.chosen_event.key if self.chosen_event else None
+        if find_match(self.events[self.chosen_event_idx::(-1 if back else 1)], skip=skip):  # search backwards if we are going backwards
+            return
+        # if we didn't find anything, search for the next day with an occurrence
+        nearest = max if back else min
+        dates = [self.session.scalar(next_dates.where(is_after)),
+                 database.next_occurrence(matching_rules, self.chosen_date, self.session, back=back)]
+        if not any(date is not None for date in dates):  # wrap around
+            dates = [self.session.scalar(next_dates.where(~is_today)),
+                     database.next_occurrence(matching_rules, 10 ** 7 if back else 0, self.session, back=back)]
+        dates = [date for date in dates if date is not None and date != self.chosen_date]
+        # if we found a date, go to it
+        if dates:
+            self.chosen_event = None
+            self.chosen_date = nearest(dates)
+            is_today = database.Event.date == self.chosen_date
+        # find the first event on that date
+        find_match(self.events[::(-1 if back else 1)])  # search backwards if we are going backwards
+
+    # MODIFY
+    def kill_event(self, group=False):
+        if self.chosen_event is None:
+            return
+        old_type = self.chosen_event.type
+        old_type_idx = getattr(self, old_type + '_idx')
+        self.yank(group=group)
+        if group:
+            database.delete_group(self.chosen_event.recurrence_parent, self.session)
+        else:
+            self.session.delete(self.chosen_record)
+        self.chosen_date = self.chosen_date  # update events
+        setattr(self, old_type + '_idx', old_type_idx)
+
+    def kill_future_events(self):
+        if self.chosen_event is None:
+            return
+        database.delete_group(self.chosen_event.recurrence_parent, self.session, from_date=self.chosen_event.date)
+
+    def postpone(self, group=False, delta=1):
+        if self.chosen_event is None:
+            return
+        if group and self.chosen_event.recurrence_parent is not None:
+            # shift siblings
+            database.shift_group(self.chosen_event.recurrence_parent, delta, self.session)
+            if self.chosen_event.rule_id is not None:
+                self.chosen_event = self.chosen_event._replace(date=self.chosen_event.date + delta)  # follow it
+        else:
+            self.chosen_record.date += delta
+
+    def postpone_one(self, group=False):
+        self.postpone(group=group, delta=1)
+
+    def prepone_one(self, group=False):
+        self.postpone(group=group, delta=-1)
+
+    def ask_field(self, field, default):
+        # prompts for a value of the field, cast to its column type
+        import questionary
+        from calamity_calendar.validators import DateValidator, CodeValidator, TimeValidator
+        # validator for field
+        validators = {'code': CodeValidator, 'date': DateValidator,
+                      'start_time': TimeValidator, 'end_time': TimeValidator}
+        validator = validators.get(field, None)
+        # default string for the field
+        if field == 'date':
+            default = datetime.date.fromordinal(default).strftime("%Y-%m-%d")
+        if field in ('start_time', 'end_time'):
+            default = '' if default is None else f'{default // 60:0>2}{default % 60:0>2}'
+        if default is None:
+            default = ''
+        # message for the field
+        message = field.replace('_', ' ').title() + ': '
+        display.invalidate()
+        new_value = questionary.text(message=message, validate=validator, default=default).ask()
+        # casting
+        if field == 'date':
+            new_value = datetime.datetime.strptime(new_value, "%Y-%m-%d").toordinal()
+        if field in ('start_time', 'end_time'):
+            time = datetime.datetime.strptime(new_value, "%H%M")
+            hour, minute = time.hour, time.minute
+            new_value = hour * 60 + minute
+        return new_value
+
+    def edit_field(self, group=False, field=None, new_value=None):
+        if self.chosen_event is None:
+            return
+        if new_value is None:
+            new_value = self.ask_field(field, getattr(self.chosen_event, field))
+        # set the field
+        if group and self.chosen_event.recurrence_parent is not None:
+            database.update_group(self.chosen_event.recurrence_parent, {field: new_value}, self.session)
+        else:
+            setattr(self.chosen_record, field, new_value)
+        # return the new value
+        return {'new_value': new_value}
+
+    def cycle_color(self, group=False, backwards=False):
+        if self.chosen_event is None:
+            return
+        old_color = self.chosen_event.color
+        new_color = colors.CYCLE_DICT[old_color] if not backwards else colors.CYCLE_DICT_BACKWARDS[old_color]
+        database.config['color'] = new_color
+        if group and self.chosen_event.recurrence_parent is not None:
+            database.update_group(self.chosen_event.recurrence_parent, {'color': new_color}, self.session)
+        else:
+            self.chosen_record.color = new_color
+
+    def cycle_color_forward(self, group=False):
+        self.cycle_color(group=group, backwards=False)
+
+    def cycle_color_backward(self, group=False):
+        self.cycle_color(group=group, backwards=True)
+
+    def toggle_type(self, group=False):
+        if self.chosen_event is None or self.chosen_event.type not in ('task', 'chore'):
+            return
+        new_type = 'chore' if self.chosen_event.type == 'task' else 'task'
+        if group and self.chosen_event.recurrence_parent is not None:
+            database.update_group(self.chosen_event.recurrence_parent, {'type': new_type}, self.session)
+        else:
+            self.chosen_record.type = new_type
+
+    def repeat_event(self, period=None, n_repetitions=None, group=False):
+        if self.chosen_event is None:
+            return
+        if period is None or n_repetitions is None:
+            import questionary
+            from calamity_calendar.validators import RepetitionValidator
+            display.invalidate()
+            period, n_repetitions = questionary.text("How many times (period+repetitions)?",
+                                                     validate=RepetitionValidator, default="7+1").ask().split('+')
+            period, n_repetitions = int(period), int(n_repetitions)
+        siblings = [self.chosen_event] if not group else database.fetch_group(
+            self.chosen_event.recurrence_parent, self.session)
+        # for each sibling in the recurrence group, create a rule for n new events with period days in between
+        rules, rows = [], []
+        for sib in siblings:
+            new_dict = sib.to_dict()
+            del new_dict['id']
+            if period == 0:  # a rule needs a period, so store the copies
+                rows += [new_dict] * n_repetitions
+            elif n_repetitions > 0:
+                first = sib.date + (period if period > 0 else n_repetitions * period)
+                rules.append(dict(new_dict, date=first, period=abs(period), count=n_repetitions, exceptions=[]))
+        # the rules of the group are repeated as a whole
+        for rule in (database.fetch_group_rules(self.chosen_event.recurrence_parent, self.session) if group else []):
+            del rule['id']
+            for i in range(1, n_repetitions + 1):
+                rules.append(dict(rule, date=rule['date'] + i * period,
+                                  exceptions=[date + i * period for date in rule['exceptions']]))
+        database.insert_rules(rules, self.session)
+        database.insert_events(rows, self.session)
+        return {'period': period, 'n_repetitions': n_repetitions}
+
+    def edit_time(self, start_time=None, end_time=None, group=False):
+        if self.chosen_event is None or self.chosen_event.type != 'appointment':
+            return
+        # both times are asked for before either is set: nothing is written (and the calendar locked) during a prompt
+        if start_time is None:
+            start_time = self.ask_field('start_time', self.chosen_event.start_time)
+        if end_time is None:
+            end_time = self.ask_field('end_time', self.chosen_event.end_time)
+        self.edit_field(field='start_time', new_value=start_time, group=group)
+        self.edit_field(field='end_time', new_value=end_time, group=group)
+        self.warn_overlaps()
+        return {'start_time': start_time, 'end_time': end_time}
+
+    def add_event(self, date=None, description=None, color=None, recurrence_parent=None, type=None, start_time=None,
+                  end_time=None, code=None):
+        # TODO use an event dict so you aren't writing out column names
+        # the event is only inserted once the prompts are answered, so the calendar isn't locked while they are open
+        if type == "task" and code is None:
+            code = self.ask_field('code', None)
+        elif type == "appointment" and (start_time is None or end_time is None):
+            start_time = self.ask_field('start_time', start_time)
+            end_time = self.ask_field('end_time', end_time)
+        if description is None:
+            description = self.ask_field('description', None)
+        new_event = Event(date=(date or self.chosen_date), description=description, color=color,
+                          recurrence_parent=recurrence_parent,
+                          type=type, start_time=start_time, end_time=end_time, code=code)
+        self.session.add(new_event)
+        self.session.flush()  # get the id of the new event
+        self.chosen_event = database.EventView.from_event(new_event)
+        if type == "appointment":
+            self.warn_overlaps()
+        return {'description': new_event.description, 'start_time': new_event.start_time,
+                'end_time': new_event.end_time, 'code': new_event.code,
+                'recurrence_parent': new_event.recurrence_parent, 'color': new_event.color}
+
+    def get_move_date(self):
+        help_text = ("[A-Z] move to a date by capital letter     A) move to the first date in view",
+                     "[0-9] move to a two digit date            14) move to the 14th of the month ",
+                     "+/-   move by day/week/month              2w) move forward two weeks        ",
+                     "                                         -1m) move back one month           ")
+        display.invalidate()
+        for line in help_text:
+            print(line.center(display.get_term_width()), end='' if line == help_text[-1] else '\n', flush=True)
+        c1 = getch()
+        english_delta, direction, n = None, 1, 1
+        # date by capital letter
+        if c1 in string.ascii_uppercase + '[\\]^_':
+            return self.from_date + ord(c1) - ord('A')
+        # two digit date
+        elif c1 in string.digits:
+            c2 = getch()
+            if c2.isdigit():
+                new_day = int(c1 + c2)
+                for date in range(self.from_date, self.from_date + display.get_num_days()):
+                    if datetime.date.fromordinal(date).day == new_day:
+                        return date
+            elif c2 in 'dwm':
+                n = int(c1)
+                english_delta = c2
+        # +/-
+        elif c1 in '+-':
+            direction = 1 if c1 == '+' else -1
+            first_digit = True
+            while True:
+                c = getch()
+                if c.isdigit():
+                    if first_digit:
+                        n = 0
+                        first_digit = False
+                    n = 10 * n + int(c)
+                elif c in 'dwm':
+                    english_delta = c
+                    break
+                else:
+                    return None  # invalid input
+        # d/w/m
+        elif c1 in 'dwm':
+            english_delta = c1
+        # get the target
+        if english_delta is not None:
+            if english_delta == 'd':
+                return self.chosen_date + n * direction
+            elif english_delta == 'w':
+                return self.chosen_date + 7 * n * direction
+            elif english_delta == 'm':
+                new_date = self.chosen_date
+                for _ in range(n):
+                    new_date = dateutils.add_month(new_date, back=(direction == -1))
+                return new_date
+
+    def move_event(self, target=None, fail=False, group=False):
+        if self.chosen_event is None:
+            return
+        if fail:
+            return
+        # get the target
+        if target is None:
+            target = self.get_move_date()
+            # did we get a target?
+            if target is None:
+                return {'fail': True}
+        self.postpone(group=group, delta=target - self.chosen_event.date)
+        return {'target': target}
+
+
+def run(path=database.DB_PATH, view=False):
+    if os.environ.get('CALAMITY_PROFILE'):
+        profiler.enable(os.environ['CALAMITY_PROFILE'])
+    database.open_calendar(path, view=view)
+    cal = Calamity()
+    # polite quit request
+    signal.signal(signal.SIGTERM, cal.sig_quit)
+    # listen to interrupt from another instance
+    signal.signal(signal.SIGUSR1, cal.sig_quit)
+    signal.signal(signal.SIGUSR2, cal.sig_quit_without_saving)
+    # listen to terminal resize
+    # signal.signal(signal.SIGWINCH, cal.redraw)
+    # save on SIGHUP
+    signal.signal(signal.SIGHUP, cal.sig_quit)
+    cal.main_loop()
@@ -0,0 +1,63 @@
+"""
+Online backups of the calendar, made with the SQLite backup API on a background thread.
+The pages are copied a few at a time, so the calendar stays usable (and other instances can keep writing to it)
+while a large calendar is backed up.
+"""
+import datetime
+import glob
+import os
+import sqlite3
+import threading
+
+PAGES_PER_STEP = 256
+
+
+class Backup(threading.Thread):
+
+    def __init__(self, path, location, snapshots=0):
+        """
+        Back up the calendar at path to location, or to a file in it if it is a directory.
+        With snapshots, every backup is a new timestamped file, and only the newest snapshots are kept.
+        """
+        super().__init__(daemon=True)
+        self.path = path
+        self.snapshots = snapshots
+        self.directory, name = (location, os.path.basename(path)) if os.path.isdir(location) else os.path.split(location)
+        self.stem, self.ext = os.path.splitext(name)
+        if snapshots:
+            name = f"{self.stem}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}{self.ext}"
+        self.target = os.path.join(self.directory, name)
+        self.remaining = self.total = None  # pages
+        self.error = None
+
+    def run(self):
+        # copy to a temporary file first, so a failed backup doesn't clobber the previous one
+        partial = self.target + '.partial'
+        try:
+            source = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+            with sqlite3.connect(partial) as target:
+                source.backup(target, pages=PAGES_PER_STEP, progress=self.progress)
+            target.close()
+            source.close()
+            os.replace(partial, self.target)
+            if self.snapshots:
+                self.prune()
+        except (sqlite3.Error, OSError) as e:
+            self.error = e
+
+    def prune(self):
+        # delete the oldest snapshots (the timestamps sort by date)
+        pattern = os.path.join(glob.escape(self.directory), glob.escape(self.stem) + '-*' + glob.escape(self.ext))
+        for old in sorted(glob.glob(pattern))[:-self.snapshots]:
+            os.remove(old)
+
+    def progress(self, status, remaining, total):
+        self.remaining, self.total = remaining, total
+
+    def status(self):
+        if self.error is not None:
+            return f"Backup failed: {self.error}"
+        if self.is_alive():
+            done = 0 if not self.total else 100 * (self.total - self.remaining) // self.total
+            return f"Backing up... {done}%"
+        return f"Backed up to {self.target}"
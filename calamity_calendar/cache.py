@@ -0,0 +1,20 @@
+from collections import OrderedDict
+
+
+class LRUCache(OrderedDict):
+    """A dict holding at most maxsize items, evicting the least recently used one when full."""
+
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
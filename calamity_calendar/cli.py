@@ -0,0 +1,43 @@
+"""
+The subcommands of calamity (run without one, calamity opens the calendar).
+"""
+import datetime
+
+from calamity_calendar import database, ics
+
+
+def parse_date(date):
+    # YYYY-MM-DD as an ordinal, None stays None
+    if date is None:
+        return None
+    return datetime.date.fromisoformat(str(date)).toordinal()
+
+
+def export(path, to=None, calendar=database.DB_PATH, **options):
+    """
+    Export the calendar to an iCalendar file: calamity export [--from YYYY-MM-DD] [--to YYYY-MM-DD] out.ics
+    """
+    database.open_calendar(calendar, view=True)
+    session = database.Session()
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        n = ics.export(file, session, parse_date(options.get('from')), parse_date(to))
+    session.close()
+    print(f"Exported {n} events to {path}.")
+
+
+def import_(path, calendar=database.DB_PATH):
+    """
+    Add the events of an iCalendar file to the calendar: calamity import in.ics
+    """
+    database.open_calendar(calendar)
+    if database.read_only:
+        print("The calendar is locked by another process. Try again later.")
+        exit(1)
+    session = database.Session()
+    with open(path, encoding='utf-8', errors='replace', newline='') as file:
+        n_events, n_rules = ics.import_(file, session)
+    session.commit()  # a single transaction: a failed import adds nothing
+    print(f"Imported {n_events} events and {n_rules} recurring events from {path}.")
+
+
+COMMANDS = {'export': export, 'import': import_}
@@ -44,6 +44,9 @@ FLASH_ON = "\033[5m"
 BOLD_OFF = "\033[22m"
 BOLD_ON = "\033[1m"
 UP_LINE = "\033[F"
+SAVE_CURSOR = "\0337"
+RESTORE_CURSOR = "\0338"
+CURSOR_TO = "\033[{row};{column}H"
 DOWN_LINE = "\033[E"
 ALT_SCREEN = "\033[?1049h"
 MAIN_SCREEN = "\033[?1049l"
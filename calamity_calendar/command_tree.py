@@ -16,7 +16,8 @@ R = ROOT = TrieNode("?) HELP     e) EDIT     z) VIEW     g) GROUP")
 R['e'] = TrieNode("   EDIT:    D) date     c) code     d) description      \n"
                   "            t) time     s) start    f) finish           \n")
 R['z'] = TrieNode("   VIEW:    l) right    h) left     j) down     k) up   \n"
-                  "            z) center   b) bottom   t) top              \n")
+                  "            z) center   b) bottom   t) top      m) memory\n"
+                  "            o) overview r) report                       \n")
 R['g'] = TrieNode("   GROUP:   e) EDIT     r) repeat   x) delete           \n"
                   "            m) move     y) yank     X) delete future    \n")
 R['g']['e'] = TrieNode(message=R['e'].message)
@@ -45,6 +46,7 @@ R['\r'] = lambda self: self.cycle_event_by_type('task')
 R['/'] = lambda self: self.get_search_term()
 R['n'] = lambda self: self.search_motion()
 R['N'] = lambda self: self.search_motion(back=True)
+R['f'] = lambda self: self.find_free_slot()
 R['*'] = lambda self: self.get_search_group()
 R['#'] = lambda self: self.get_search_group(back=True)
 R['0'] = lambda self: setattr(self, 'chosen_event_idx',
@@ -64,6 +66,9 @@ R['z']['l'] = lambda self: database.config.__setitem__('start_hour', database.co
 R['z']['0'] = lambda self: database.config.__setitem__('military_time', not database.config['military_time'])
 R['z']['?'] = lambda self: database.config.__setitem__('show_help', not database.config['show_help'])
 R['g']['?'] = lambda self: database.config.__setitem__('ROT13', not database.config['ROT13'])
+R['z']['m'] = lambda self: self.show_memory()
+R['z']['o'] = lambda self: self.toggle_overview()
+R['z']['r'] = lambda self: self.show_report()
 R['\x1b']['[']['A'] = R['z']['k']
 R['\x1b']['[']['B'] = R['z']['j']
 R['\x1b']['[']['D'] = R['z']['h']
@@ -2,17 +2,22 @@ import sqlalchemy
 import datetime
 import os
 import json
+import itertools
+import collections
+import contextlib
+import queue
+import sqlite3
+import threading
 import time
-import subprocess
-import re
-
-import questionary
 
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-from calamity_calendar import colors
+from calamity_calendar import colors, cache, state
+from calamity_calendar import agenda
+from calamity_calendar.agenda import DB_PATH, EVENTS_SQL, OCCURRENCES_SQL, fts_query
+from calamity_calendar.state import EVENT_FIELDS, EventView, default_config, make_window, versions
 
 # Declare the base
 Base = declarative_base()
@@ -52,16 +57,6 @@ class Event(Base):
         # return a random 4 byte integer
         return int.from_bytes(os.urandom(4), byteorder='big')
 
-    def copy(self):
-        return Event(date=self.date,
-                     description=self.description,
-                     color=self.color,
-                     recurrence_parent=self.recurrence_parent,
-                     type=self.type,
-                     start_time=self.start_time,
-                     end_time=self.end_time,
-                     code=self.code)
-
     def __repr__(self):
         return f"Event({self.date}, {self.description}, {self.color}, {self.recurrence_parent}, {self.type}, {self.start_time}, {self.end_time}, {self.code})"
 
@@ -69,6 +64,61 @@ class Event(Base):
         return {key: getattr(self, key) for key in self.__table__.columns.keys()}
 
 
+# Declare the table of recurrence rules
+# A rule stands for `count` events, `period` days apart, starting on `date`. The events are not stored,
+# fetch_window expands the rules for the visible dates only.
+class Rule(Base):
+    __tablename__ = 'rules'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    date = sqlalchemy.Column(sqlalchemy.Integer)  # date of the first occurrence, stored as julian date
+    period = sqlalchemy.Column(sqlalchemy.Integer)  # days between occurrences, at least 1
+    count = sqlalchemy.Column(sqlalchemy.Integer)  # number of occurrences
+    # the occurrences copy these fields (see Event)
+    description = sqlalchemy.Column(sqlalchemy.String, default="")
+    color = sqlalchemy.Column(sqlalchemy.String)
+    recurrence_parent = sqlalchemy.Column(sqlalchemy.Integer)
+    type = sqlalchemy.Column(sqlalchemy.String, default='task')
+    start_time = sqlalchemy.Column(sqlalchemy.Integer)
+    end_time = sqlalchemy.Column(sqlalchemy.Integer)
+    code = sqlalchemy.Column(sqlalchemy.String, default="")
+
+
+# Occurrences of a rule which are not shown, because they were deleted
+# or materialized as an event (to be edited on their own)
+class RuleException(Base):
+    __tablename__ = 'rule_exceptions'
+
+    rule_id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    date = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+
+# The undo history, kept in the database so it survives quitting. A step is one edit; its changes are logged
+# as the SQL that reverts them, which is replaced by the SQL that reapplies them when the step is undone.
+class UndoStep(Base):
+    __tablename__ = 'undo_steps'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    undone = sqlalchemy.Column(sqlalchemy.Boolean, default=False)
+    date = sqlalchemy.Column(sqlalchemy.Integer)  # the chosen date and event when the edit was made, to go back there
+    event_idx = sqlalchemy.Column(sqlalchemy.Integer)
+    # the session (see session_id) that made the step, and the one that undid it: quitting without saving reverts both
+    session = sqlalchemy.Column(sqlalchemy.Integer)
+    undone_by = sqlalchemy.Column(sqlalchemy.Integer)
+    forgotten = sqlalchemy.Column(sqlalchemy.Boolean, default=False)  # undone, then an edit was made: can't be redone
+
+
+class UndoLog(Base):
+    __tablename__ = 'undo_log'
+
+    seq = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    step = sqlalchemy.Column(sqlalchemy.Integer, index=True)  # NULL until the edit is over
+    statement = sqlalchemy.Column(sqlalchemy.String)
+
+
+assert EVENT_FIELDS == Event.__table__.columns.keys()
+
+
 class Config(Base):
     __tablename__ = 'config'
 
@@ -78,126 +128,666 @@ class Config(Base):
 
 
 class ConfigDict:
+    """
+    The config table as a dict of decoded values.
+    Changes are kept in memory and only the changed keys are written back by commit().
+    """
 
     def __init__(self, defaults):
         self.defaults = defaults
         self.session = Session()
-        self._dict = {row.key: row for row in self.session.query(Config).all()}
+        self.version = 0  # bumped on every change, so render caches can notice config changes
+        self.load()
+
+    def load(self):
+        self._records = {row.key: row for row in self.session.query(Config).all()}  # Config objects (sql records)
+        self._dict = {key: json.loads(record.value) for key, record in self._records.items()}
+        self._dirty = set()  # keys changed since the last commit
         self.__contains__ = self._dict.__contains__
         self.init_defaults()
 
     def init_defaults(self):
         for key, value in self.defaults.items():
-            if key not in self._dict:
-                self._dict[key] = Config(key=key)  # create a new record
+            if key not in self._records:
+                self._records[key] = Config(key=key)  # create a new record
+                self.session.add(self._records[key])
                 self[key] = value
-                self.session.add(self._dict[key])
 
     def commit(self):
+        if read_only:
+            return  # a viewer's changes (e.g. scrolling the timetable) are not saved
+        for key in self._dirty:
+            self._records[key].value = json.dumps(self._dict[key])
+            self.session.add(self._records[key])  # again, if the session was rolled back after a failed commit
         self.session.commit()
+        self._dirty.clear()
+
+    def rollback(self):
+        # discard the changes since the last commit
+        self.session.rollback()
+        self.version += 1
+        self.load()
 
     def __getitem__(self, key):
-        return json.loads(self._dict[key].value)  # self._dict[key] is a Config object (sql record)
+        return self._dict[key]
 
     def __setitem__(self, key, value):
         assert key in self.defaults
-        self._dict[key].value = json.dumps(value)  # self._dict[key] is a Config object (sql record)
+        if key not in self._dict or self._dict[key] != value:
+            self._dict[key] = value
+            self._dirty.add(key)
+            self.version += 1
 
     def __repr__(self):
-        return repr({key: self[key] for key in self._dict.keys()})
-
-
-def fetch_events(date, session):
-    return fetch_appointments(date, session), fetch_tasks(date, session), fetch_chores(date, session)
-
-
-def fetch_appointments(date, session):
-    return session.query(Event).filter_by(date=date, type="appointment").order_by(Event.start_time).all()
-
-
-def fetch_tasks(date, session):
-    return session.query(Event).filter_by(date=date, type="task").all()
+        return repr(self._dict)
+
+
+class DataWatcher:
+    """
+    Notices changes committed to the calendar by other connections (another instance of calamity, a script).
+    SQLite bumps PRAGMA data_version of a connection when another connection commits, so it is polled
+    on the connection of the application's session.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection  # a DBAPI connection, whose own commits don't count as changes
+        self.data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def check(self):
+        # if the calendar changed since the last check, any date may have changed
+        data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self.data_version:
+            return False
+        self.data_version = data_version
+        versions.touch_all()
+        return True
 
 
-def fetch_chores(date, session):
-    return session.query(Event).filter_by(date=date, type="chore").all()
+def touch_flushed(session, flush_context):
+    # the old date of a moved event changed too, a changed rule can touch any date
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, (Event, RuleException)):
+            versions.touch(obj.date)
+            for date in sqlalchemy.inspect(obj).attrs.date.history.deleted:
+                versions.touch(date)
+        elif isinstance(obj, Rule):
+            versions.touch_all()
+
+
+def touch_executed(orm_execute_state):
+    # bulk inserts of events touch the dates of their rows, other bulk statements (e.g. group updates) can touch any date
+    rows = orm_execute_state.parameters
+    is_event = orm_execute_state.bind_mapper is not None and orm_execute_state.bind_mapper.class_ is Event
+    if orm_execute_state.is_insert and is_event and isinstance(rows, list) and all('date' in row for row in rows):
+        for row in rows:
+            versions.touch(row['date'])
+    elif orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert:
+        versions.touch_all()
+
+
+def search_matching(search, model=Event):
+    # events (or rules) whose description or code match the search, using the full-text index
+    table = model.__tablename__ + '_fts'
+    matches = sqlalchemy.text(f"SELECT rowid FROM {table} WHERE {table} MATCH :query").bindparams(
+        query=fts_query(search)).columns(sqlalchemy.column('rowid'))
+    return model.id.in_(matches)
+
+
+def fetch_event(event_id, session):
+    row = session.execute(sqlalchemy.select(*Event.__table__.columns).where(Event.id == event_id)).first()
+    return EventView(*row) if row else None
+
+
+def fetch_occurrence(rule_id, date, session):
+    row = session.execute(sqlalchemy.text(OCCURRENCES_SQL + " AND rules.id = :rule_id"),
+                          {'from_date': date, 'to_date': date + 1, 'rule_id': rule_id}).first()
+    return EventView(*row) if row else None
+
+
+def refetch(event, session):
+    # fetch the current version of an EventView, None if it no longer exists
+    if event.rule_id is None:
+        return fetch_event(event.id, session)
+    return fetch_occurrence(event.rule_id, event.date, session)
+
+
+def fetch_group(recurrence_parent, session):
+    # the events of a recurrence group, not including the occurrences of its rules (see fetch_group_rules)
+    rows = session.execute(sqlalchemy.select(*Event.__table__.columns).where(
+        Event.recurrence_parent == recurrence_parent).order_by(Event.date, Event.id))
+    return [EventView(*row) for row in rows]
+
+
+def fetch_group_rules(recurrence_parent, session):
+    # the rules of a recurrence group as dicts, with the list of their exception dates
+    rules = session.query(*Rule.__table__.columns).filter_by(recurrence_parent=recurrence_parent).all()
+    exceptions = collections.defaultdict(list)
+    for rule_id, date in session.execute(sqlalchemy.select(RuleException.rule_id, RuleException.date).where(
+            RuleException.rule_id.in_([rule.id for rule in rules]))):
+        exceptions[rule_id].append(date)
+    return [dict(rule._asdict(), exceptions=exceptions[rule.id]) for rule in rules]
+
+
+def next_occurrence(matching, date, session, back=False):
+    # the first date after (before, if back) date on which a rule matching the clause occurs, or None
+    rules = session.execute(sqlalchemy.select(Rule.id, Rule.date, Rule.period, Rule.count).where(matching)).all()
+    exceptions = set(session.execute(sqlalchemy.select(RuleException.rule_id, RuleException.date).where(
+        RuleException.rule_id.in_([rule.id for rule in rules]))).tuples())
+    dates = []
+    for rule in rules:
+        step = -1 if back else 1
+        n = (date - rule.date) // rule.period + (0 if back and (date - rule.date) % rule.period else step)
+        n = min(n, rule.count - 1) if back else max(n, 0)
+        while 0 <= n < rule.count and (rule.id, rule.date + n * rule.period) in exceptions:
+            n += step
+        if 0 <= n < rule.count:
+            dates.append(rule.date + n * rule.period)
+    return (max(dates) if back else min(dates)) if dates else None
+
+
+def materialize(occurrence, session):
+    # replace an occurrence of a rule by an event of its own (an exception of the rule), so it can be edited
+    session.add(RuleException(rule_id=occurrence.rule_id, date=occurrence.date))
+    event = Event(**occurrence.to_dict())
+    session.add(event)
+    session.flush()  # get the id of the new event
+    return event
+
+
+def update_group(recurrence_parent, values, session):
+    # set fields ({name: value}) of every event and rule in a recurrence group
+    for model in (Event, Rule):
+        session.query(model).filter_by(recurrence_parent=recurrence_parent).update(values)
+
+
+def shift_group(recurrence_parent, delta, session):
+    # move every event and rule in a recurrence group by delta days
+    rule_ids = sqlalchemy.select(Rule.id).where(Rule.recurrence_parent == recurrence_parent)
+    # (rule_id, date) is unique after each row is updated, so the exceptions of a daily rule can't be shifted in place:
+    # they go through negative dates
+    exceptions = session.query(RuleException).filter(RuleException.rule_id.in_(rule_ids))
+    exceptions.update({RuleException.date: -(RuleException.date + delta)})
+    exceptions.filter(RuleException.date < 0).update({RuleException.date: -RuleException.date})
+    for model in (Event, Rule):
+        session.query(model).filter_by(recurrence_parent=recurrence_parent).update({model.date: model.date + delta})
+
+
+def delete_group(recurrence_parent, session, from_date=None):
+    # delete every event and rule occurrence in a recurrence group (on or after from_date, if given)
+    events = session.query(Event).filter_by(recurrence_parent=recurrence_parent)
+    rules = session.query(Rule).filter_by(recurrence_parent=recurrence_parent)
+    if from_date is not None:
+        events = events.filter(Event.date >= from_date)
+        # rules which started earlier keep their occurrences before from_date
+        rules.filter(Rule.date < from_date).update(
+            {Rule.count: sqlalchemy.func.min(Rule.count, (from_date - Rule.date + Rule.period - 1) // Rule.period)})
+        rules = rules.filter(Rule.date >= from_date)
+    events.delete()
+    rules.delete()
+    session.query(RuleException).filter(RuleException.rule_id.not_in(sqlalchemy.select(Rule.id))).delete()
+
+
+def insert_rules(rows, session):
+    # insert a list of rule dicts (each with a list of exception dates), one statement for each table
+    if not rows:
+        return
+    rules = [{key: value for key, value in row.items() if key != 'exceptions'} for row in rows]
+    ids = session.scalars(sqlalchemy.insert(Rule).returning(Rule.id, sort_by_parameter_order=True), rules).all()
+    exceptions = [{'rule_id': rule_id, 'date': date} for rule_id, row in zip(ids, rows) for date in row['exceptions']]
+    if exceptions:
+        session.execute(sqlalchemy.insert(RuleException), exceptions)
+
+
+def insert_events(rows, session):
+    # insert a list of event dicts with a single executemany, returns their new ids in order
+    if not rows:
+        return []
+    statement = sqlalchemy.insert(Event).returning(Event.id, sort_by_parameter_order=True)
+    return session.scalars(statement, rows).all()
 
 
-# Create the file if it doesn't exist
-# the database file will live in ~/.local/share/calamity/events.db
-DB_PATH = os.path.join(os.path.expanduser('~'), '.local', 'share', 'calamity', 'events.db')
-if not os.path.exists(os.path.dirname(DB_PATH)):
-    os.makedirs(os.path.dirname(DB_PATH))
+def fetch_events(date, session):
+    return fetch_window(date, 1, session)[date]
+
+
+def fetch_window(from_date, n_days, session):
+    # the events in [from_date, from_date + n_days), from the day cache if they haven't changed since they were fetched
+    # returns {date: (appointments, tasks, chores)} with an entry for every date in the window
+    session.flush()  # the versions have to count the pending changes
+    collect_prefetched(from_date, from_date + n_days)
+    missing = [date for date in range(from_date, from_date + n_days) if not is_cached(date)]
+    window = query_window(missing[0], missing[-1] + 1 - missing[0], session) if missing else {}
+    for date, day in window.items():
+        day_cache[date] = versions[date], day
+    return {date: window[date] if date in window else day_cache[date][1]
+            for date in range(from_date, from_date + n_days)}
+
+
+def query_window(from_date, n_days, session):
+    # fetch every event in [from_date, from_date + n_days) with a single range query, plus the rule occurrences
+    rows = session.execute(sqlalchemy.select(*Event.__table__.columns).where(
+        Event.date >= from_date, Event.date < from_date + n_days).order_by(Event.date, Event.start_time, Event.id))
+    occurrences = session.execute(sqlalchemy.text(OCCURRENCES_SQL + " ORDER BY rules.id"),
+                                  {'from_date': from_date, 'to_date': from_date + n_days})
+    return make_window(from_date, n_days, itertools.chain(rows, occurrences))
+
+
+# THE DAY CACHE
+# {date: (version, (appointments, tasks, chores))}, filled by fetch_window and by the prefetcher
+# an entry is only used while the version of its date is the one it was fetched at
+DAY_CACHE_SIZE = 512
+day_cache = cache.LRUCache(DAY_CACHE_SIZE)
+
+
+def is_cached(date):
+    return date in day_cache and day_cache[date][0] == versions[date]
+
+
+class Prefetcher(threading.Thread):
+    """
+    Loads windows of days in the background, with its own read-only connection, while the application waits for
+    keys (see prefetching). The windows go back to the main thread (see collect_prefetched), which owns the session
+    and the day cache, with the versions of their dates when they were requested: a day changed meanwhile isn't cached.
+    """
+
+    def __init__(self, path):
+        super().__init__(daemon=True)
+        self.path = path
+        self.requests = queue.Queue()  # (from_date, n_days, {date: version}), None to stop
+        self.results = queue.Queue()  # (from_date, n_days, window or None, {date: version})
+        self.pending = {}  # {(from_date, n_days): {date: version}} requested and not collected yet
+        self.idle = threading.Event()  # set while the application waits for a key
+        self.loading = None  # the (from_date, n_days) being loaded
+        self.stopped = False
+
+    def run(self):
+        connection = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        for request in iter(self.requests.get, None):
+            from_date, n_days, dates = request
+            self.wait_for_idle()
+            if self.stopped:
+                break
+            self.loading = from_date, n_days
+            params = {'from_date': from_date, 'to_date': from_date + n_days}
+            try:
+                rows = itertools.chain(connection.execute(EVENTS_SQL + " ORDER BY date, start_time, id", params),
+                                       connection.execute(OCCURRENCES_SQL + " ORDER BY rules.id", params))
+                window = make_window(from_date, n_days, rows)
+            except sqlite3.Error:
+                window = None  # e.g. the calendar was replaced, fetch_window will query it
+            self.results.put((from_date, n_days, window, dates))
+            self.loading = None
+        connection.close()
+
+    def wait_for_idle(self):
+        # the application has to be waiting for a few milliseconds already: a burst of keys isn't idle time
+        while True:
+            self.idle.wait()
+            time.sleep(PREFETCH_DELAY)
+            if self.idle.is_set():
+                return
+
+    def stop(self):
+        self.stopped = True
+        self.requests.put(None)
+        self.idle.set()
+
+
+def prefetch(windows):
+    # load the days of the windows [(from_date, n_days), ...] missing from the day cache in the background,
+    # instead of the windows requested before and not started yet
+    global prefetcher
+    if calendar_path is None:
+        return
+    if prefetcher is None:
+        prefetcher = Prefetcher(calendar_path)
+        prefetcher.start()
+    try:
+        while True:
+            from_date, n_days, _ = prefetcher.requests.get_nowait()
+            del prefetcher.pending[from_date, n_days]
+    except queue.Empty:
+        pass
+    for from_date, n_days in windows:
+        missing = [date for date in range(from_date, from_date + n_days) if not is_cached(date)]
+        if missing and (missing[0], missing[-1] + 1 - missing[0]) not in prefetcher.pending:
+            from_date, n_days = missing[0], missing[-1] + 1 - missing[0]
+            dates = {date: versions[date] for date in range(from_date, from_date + n_days)}
+            prefetcher.pending[from_date, n_days] = dates
+            prefetcher.requests.put((from_date, n_days, dates))
+
+
+@contextlib.contextmanager
+def prefetching():
+    # the prefetcher only works in the block, so that it doesn't slow down the commands and the drawing
+    if prefetcher is None:
+        yield
+        return
+    prefetcher.idle.set()
+    try:
+        yield
+    finally:
+        prefetcher.idle.clear()
+
+
+def collect_prefetched(first, last):
+    # cache the windows loaded by the prefetcher, waiting for the one being loaded if it has days of [first, last)
+    # that haven't changed since it was requested
+    if prefetcher is None:
+        return
+    while prefetcher.pending:
+        dates = prefetcher.pending.get(prefetcher.loading, {})
+        waiting = any(dates[date] == versions[date] for date in range(first, last) if date in dates)
+        try:
+            from_date, n_days, window, dates = prefetcher.results.get(block=waiting, timeout=PREFETCH_TIMEOUT)
+        except queue.Empty:
+            return
+        del prefetcher.pending[from_date, n_days]
+        for date, day in (window or {}).items():
+            if dates[date] == versions[date]:
+                day_cache[date] = dates[date], day
+
+
+# the free slot finder searches a month of appointments at a time, up to five years ahead
+FREE_SLOT_CHUNK = 31
+FREE_SLOT_HORIZON = 5 * 366
+
+
+def fetch_intervals(from_date, to_date, session):
+    # {date: [(start_time, end_time), ...]} of the timed appointments (and occurrences) in [from_date, to_date),
+    # sorted by start time; the events come from the covering index on (type, date, start_time, end_time)
+    timed = (Event.type == 'appointment', Event.start_time.is_not(None), Event.end_time.is_not(None))
+    rows = session.execute(sqlalchemy.select(Event.date, Event.start_time, Event.end_time).where(
+        *timed, Event.date >= from_date, Event.date < to_date))
+    occurrences = session.execute(sqlalchemy.text(
+        f"SELECT date, start_time, end_time FROM ({OCCURRENCES_SQL}) "
+        "WHERE type = 'appointment' AND start_time IS NOT NULL AND end_time IS NOT NULL"),
+        {'from_date': from_date, 'to_date': to_date})
+    intervals = collections.defaultdict(list)
+    for date, start_time, end_time in itertools.chain(rows, occurrences):
+        intervals[date].append((start_time, end_time))
+    for day in intervals.values():
+        day.sort()
+    return intervals
+
+
+def day_totals(from_date, to_date, session):
+    """
+    {date: {(type, color): (count, booked minutes)}} for the events and rule occurrences in [from_date, to_date),
+    aggregated by a single GROUP BY, so no events are loaded. Only timed appointments book minutes.
+    """
+    rows = session.execute(sqlalchemy.text(f"""
+        SELECT date, type, color, COUNT(*), SUM(CASE WHEN type = 'appointment' THEN end_time - start_time END)
+        FROM (SELECT date, type, color, start_time, end_time FROM events WHERE date >= :from_date AND date < :to_date
+              UNION ALL
+              SELECT date, type, color, start_time, end_time FROM ({OCCURRENCES_SQL}))
+        GROUP BY date, type, color"""), {'from_date': from_date, 'to_date': to_date})
+    totals = collections.defaultdict(dict)
+    for date, kind, color, count, minutes in rows:
+        totals[date][kind, color] = count, minutes or 0
+    return totals
+
+
+def report(from_date, to_date, by, period, session):
+    # the rows of a time report (see agenda.report_sql), as the session reads them
+    return agenda.report(lambda sql, params: session.execute(sqlalchemy.text(sql), params), from_date, to_date, by,
+                         period)
+
+
+def overlapping(event, session):
+    # the appointments on the day of event whose time overlaps it
+    if event.type != 'appointment' or event.start_time is None or event.end_time is None:
+        return []
+    appointments, _, _ = fetch_events(event.date, session)
+    return [other for other in appointments if other.key != event.key and other.start_time is not None and
+            other.end_time is not None and other.start_time < event.end_time and event.start_time < other.end_time]
+
+
+def free_slot(date, time, minutes, first_time, last_time, weekdays, session, horizon=FREE_SLOT_HORIZON):
+    """
+    The (date, start time) of the first gap of minutes between appointments from date and time on, between
+    first_time and last_time (minutes since midnight) of a day, on weekdays only if weekdays is True.
+    The days are searched a month at a time, up to horizon days ahead. Returns None if there is no such gap.
+    """
+    for from_date in range(date, date + horizon, FREE_SLOT_CHUNK):
+        intervals = fetch_intervals(from_date, from_date + FREE_SLOT_CHUNK, session)
+        for day in range(from_date, from_date + FREE_SLOT_CHUNK):
+            if weekdays and datetime.date.fromordinal(day).weekday() >= 5:
+                continue
+            start = max(first_time, time) if day == date else first_time
+            for start_time, end_time in intervals.get(day, []) + [(last_time, last_time)]:
+                if min(start_time, last_time) - start >= minutes:
+                    return day, start
+                start = max(start, end_time)
+    return None
+
+
+def fts_migration(table):
+    # full-text index over the description and code of table, kept in sync by triggers
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(description, code, content='{table}', "
+        f"content_rowid='id')",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {table}_fts (rowid, description, code) VALUES (new.id, new.description, new.code); END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {table}_fts ({table}_fts, rowid, description, code) "
+        f"VALUES ('delete', old.id, old.description, old.code); END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF description, code ON {table} BEGIN "
+        f"INSERT INTO {table}_fts ({table}_fts, rowid, description, code) "
+        f"VALUES ('delete', old.id, old.description, old.code); "
+        f"INSERT INTO {table}_fts (rowid, description, code) VALUES (new.id, new.description, new.code); END",
+        f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')",
+    ]
+
+
+# Schema migrations, run in order on startup. PRAGMA user_version counts the migrations already applied,
+# so existing databases are upgraded in place. Append new migrations, never edit old ones.
+MIGRATIONS = [
+    # the window query filters on date (and type), recurrence group operations filter on recurrence_parent
+    ["CREATE INDEX IF NOT EXISTS ix_events_date_type_start_time ON events (date, type, start_time)",
+     "CREATE INDEX IF NOT EXISTS ix_events_recurrence_parent_date ON events (recurrence_parent, date)"],
+    # full-text index for search
+    fts_migration('events'),
+    # recurrence rules (the tables themselves are created by create_all)
+    ["CREATE INDEX IF NOT EXISTS ix_rules_recurrence_parent ON rules (recurrence_parent)",
+     "CREATE INDEX IF NOT EXISTS ix_rules_date ON rules (date)"] + fts_migration('rules'),
+    # appointment intervals (the free slot finder), answered from the index alone
+    ["CREATE INDEX IF NOT EXISTS ix_events_type_date_start_time_end_time "
+     "ON events (type, date, start_time, end_time)"],
+    # the sessions that made and undid the steps of the undo history (a new calendar already has the columns)
+    ["CREATE TABLE undo_steps_new (id INTEGER NOT NULL PRIMARY KEY, undone BOOLEAN, date INTEGER, event_idx INTEGER, "
+     "session INTEGER, undone_by INTEGER, forgotten BOOLEAN)",
+     "INSERT INTO undo_steps_new (id, undone, date, event_idx, forgotten) "
+     "SELECT id, undone, date, event_idx, 0 FROM undo_steps",
+     "DROP TABLE undo_steps",
+     "ALTER TABLE undo_steps_new RENAME TO undo_steps"],
+]
+
+
+# the tables whose changes can be undone
+UNDO_LOG_MODELS = (Event, Rule, RuleException)
+
+
+def undo_log_triggers():
+    # temporary triggers (private to the connection, so only our own edits are logged) that log the SQL
+    # reverting every change to the undo log; updates only log the columns that changed
+    # rows are addressed by rowid, which other writers (e.g. calamity import) may reuse for another row after a delete,
+    # so the deletes and updates only apply to a row that is still as the change left it
+    statements = []
+    for model in UNDO_LOG_MODELS:
+        table = model.__tablename__
+        columns = [column for column in model.__table__.columns.keys() if column != 'id']  # id is the rowid
+        old_values = " || ', ' || ".join(f"quote(old.{column})" for column in columns)
+        new_row = " || ".join(f"' AND {column} IS ' || quote(new.{column})" for column in columns)
+        changed = " OR ".join(f"old.{column} IS NOT new.{column}" for column in columns)
+        old_assignments = " || ".join(f"CASE WHEN old.{column} IS NOT new.{column} "
+                                      f"THEN ', {column} = ' || quote(old.{column}) ELSE '' END" for column in columns)
+        statements += [
+            f"""CREATE TEMP TRIGGER undo_{table}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO undo_log (statement) VALUES ('DELETE FROM {table} WHERE rowid = ' || new.rowid ||
+                                                         {new_row}); END""",
+            f"""CREATE TEMP TRIGGER undo_{table}_update AFTER UPDATE ON {table} WHEN {changed} BEGIN
+                INSERT INTO undo_log (statement) VALUES ('UPDATE {table} SET ' || substr({old_assignments}, 3) ||
+                                                         ' WHERE rowid = ' || old.rowid || {new_row}); END""",
+            f"""CREATE TEMP TRIGGER undo_{table}_delete BEFORE DELETE ON {table} BEGIN
+                INSERT INTO undo_log (statement) VALUES ('INSERT OR IGNORE INTO {table} (rowid, {', '.join(columns)}) '
+                                                         || 'VALUES (' || old.rowid || ', ' || {old_values} || ')'); END""",
+        ]
+    return statements
+
+
+def end_step(date, event_idx, depth, session):
+    # make the changes logged since the last step into a new step of the undo history (unless there are none)
+    # a new step forgets the undone steps, which can't be redone anymore, and the steps beyond depth
+    # (the undone steps are kept for the session that undid them, in case it quits without saving)
+    session.flush()
+    execute = lambda statement, **params: session.execute(sqlalchemy.text(statement), params)
+    if execute("SELECT 1 FROM undo_log WHERE step IS NULL LIMIT 1").first() is None:
+        return
+    execute("DELETE FROM undo_log WHERE step IN (SELECT id FROM undo_steps WHERE undone AND undone_by IS NULL)")
+    execute("DELETE FROM undo_steps WHERE undone AND undone_by IS NULL")
+    execute("UPDATE undo_steps SET forgotten = 1 WHERE undone")
+    step = execute("INSERT INTO undo_steps (undone, date, event_idx, session, forgotten) "
+                   "VALUES (0, :date, :event_idx, :session, 0) RETURNING id",
+                   date=date, event_idx=event_idx, session=session_id).scalar()
+    execute("UPDATE undo_log SET step = :step WHERE step IS NULL", step=step)
+    oldest = execute("SELECT id FROM undo_steps ORDER BY id DESC LIMIT 1 OFFSET :depth", depth=depth).scalar()
+    if oldest is not None:
+        execute("DELETE FROM undo_log WHERE step <= :oldest", oldest=oldest)
+        execute("DELETE FROM undo_steps WHERE id <= :oldest", oldest=oldest)
+
+
+def undo_step(session, redo=False, step_id=None):
+    """
+    Undo the newest step of the undo history, or redo the oldest undone step (or undo or redo the step step_id).
+    Returns the step (with the date and event_idx where it was made), or None if there is nothing to undo.
+    """
+    execute = lambda statement, **params: session.execute(sqlalchemy.text(statement), params)
+    if step_id is not None:
+        step = execute("SELECT id, date, event_idx FROM undo_steps WHERE id = :step", step=step_id).first()
+    elif redo:
+        step = execute("SELECT id, date, event_idx FROM undo_steps WHERE undone AND NOT forgotten "
+                       "ORDER BY id LIMIT 1").first()
+    else:
+        step = execute("SELECT id, date, event_idx FROM undo_steps WHERE NOT undone ORDER BY id DESC LIMIT 1").first()
+    if step is None:
+        return None
+    session.flush()
+    statements = execute("SELECT statement FROM undo_log WHERE step = :step ORDER BY seq DESC", step=step.id).scalars().all()
+    execute("DELETE FROM undo_log WHERE step = :step", step=step.id)
+    for statement in statements:
+        session.connection().exec_driver_sql(statement)  # not text(), values may contain colons
+    # the triggers logged the statements that revert these ones, which redo (or undo again) the step
+    execute("UPDATE undo_log SET step = :step WHERE step IS NULL", step=step.id)
+    execute("UPDATE undo_steps SET undone = :undone, undone_by = :undone_by, forgotten = 0 WHERE id = :step",
+            undone=not redo, undone_by=None if redo else session_id, step=step.id)
+    session.expire_all()  # invalidates all cached objects, must reload them from the database
+    versions.touch_all()
+    return step
+
+
+def discard_steps(session):
+    # revert the edits of this session (see session_id), leaving those of other sessions: undo the steps it made,
+    # newest first, and forget them, then redo the steps of other sessions it undid, oldest first
+    execute = lambda statement, **params: session.execute(sqlalchemy.text(statement), params)
+    made = "SELECT id FROM undo_steps WHERE session = :session AND NOT undone ORDER BY id DESC LIMIT 1"
+    while (step_id := execute(made, session=session_id).scalar()) is not None:
+        undo_step(session, step_id=step_id)
+    execute("DELETE FROM undo_log WHERE step IN (SELECT id FROM undo_steps WHERE session = :session)",
+            session=session_id)
+    execute("DELETE FROM undo_steps WHERE session = :session", session=session_id)
+    undone = "SELECT id FROM undo_steps WHERE undone_by = :session ORDER BY id LIMIT 1"
+    while (step_id := execute(undone, session=session_id).scalar()) is not None:
+        undo_step(session, redo=True, step_id=step_id)
+
+
+def release_steps(session):
+    # on quitting, the steps this session undid are left to the others: those that can't be redone are forgotten
+    execute = lambda statement, **params: session.execute(sqlalchemy.text(statement), params)
+    execute("DELETE FROM undo_log WHERE step IN (SELECT id FROM undo_steps WHERE undone_by = :session AND forgotten)",
+            session=session_id)
+    execute("DELETE FROM undo_steps WHERE undone_by = :session AND forgotten", session=session_id)
+    execute("UPDATE undo_steps SET undone_by = NULL WHERE undone_by = :session", session=session_id)
+
+
+def migrate(engine):
+    with engine.begin() as connection:
+        user_version = connection.execute(sqlalchemy.text("PRAGMA user_version")).scalar()
+        for version, statements in enumerate(MIGRATIONS[user_version:], start=user_version + 1):
+            for statement in statements:
+                connection.execute(sqlalchemy.text(statement))
+            connection.execute(sqlalchemy.text(f"PRAGMA user_version = {version}"))
+
+
+# how long (in seconds) a writer waits for another writer to release the lock before giving up
+BUSY_TIMEOUT = 2
 
 
 def is_locked(engine):
+    # whether another process has held the write lock for longer than BUSY_TIMEOUT (editors hold it for milliseconds)
     try:
-        # Create the tables if they don't exist
-        Base.metadata.create_all(engine)
-        # Try to set check_lock=1 as a test of whether we can acquire a write lock (dummy operation, has no meaning)
         with engine.connect() as connection:
-            trans = connection.begin()
-            connection.execute(sqlalchemy.text("UPDATE config SET value = '1' WHERE key = 'check_lock'"))
-            trans.commit()
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            connection.exec_driver_sql("ROLLBACK")
         return False
     except sqlalchemy.exc.OperationalError:
         return True
 
 
-# pgrep the other instance of calamity
-def get_other_instance_pids():
-    output = subprocess.check_output(['pgrep', '-f', 'calamity_calendar'])
-    output = output.decode('utf-8')
-    pids = re.findall(r'\d+', output)
-    pids = [int(pid) for pid in pids]
-    pids.remove(os.getpid())
-    return pids
-
-
-# Connect to the database if nobody else is using it
-engine = create_engine(f'sqlite:///{DB_PATH}', connect_args={'timeout': 0})
-if is_locked(engine):
-    if pids := get_other_instance_pids():
-        assert len(pids) == 1, f"Multiple instances of calamity are running (pids {pids})."
-        if questionary.confirm(f"Calamity is already running (pid {pids[0]}). Kill it?", default=True).ask():
-            # ask the other instance to save changes
-            if questionary.confirm("Save changes from the other instance?", default=True).ask():
-                print("Saving changes...")
-                for pid in pids:
-                    os.kill(pid, 10)  # SIGUSR1, quit with save
-            else:
-                print("Discarding changes...")
-                for pid in pids:
-                    os.kill(pid, 12)  # SIGUSR2, quit without save
-            # wait 1s for the other instance to exit
-            for _ in range(100):
-                time.sleep(0.01)
-                if not get_other_instance_pids():
-                    break
-            # make sure the other instance exited
-            if get_other_instance_pids():
-                print("Other instance failed to exit. Exiting.")
-                exit(1)
-            # try to connect again
-            if is_locked(engine):
-                print("Database is still locked. Exiting.")
-                exit(1)
-        # if the user doesn't want to kill the other instance, exit
-        else:
-            print("Database is locked. Exiting.")
+# Set by open_calendar
+engine = None
+connection = None  # the connection of the application's session, whose edits are logged for undo
+session_id = None  # identifies this session in the undo history, which is shared by every session
+config = None
+read_only = False  # True when viewing a calendar that another instance is editing
+watcher = None
+calendar_path = None  # read by the prefetcher and by backups
+prefetcher = None  # started by the first prefetch
+PREFETCH_DELAY = 0.005  # seconds of waiting for a key before the prefetcher starts working
+PREFETCH_TIMEOUT = 1  # seconds to wait for a window being prefetched before querying it
+
+# Create a session factory, bound to the database by open_calendar
+Session = sessionmaker()
+sqlalchemy.event.listen(Session, 'after_flush', touch_flushed)
+sqlalchemy.event.listen(Session, 'do_orm_execute', touch_executed)
+
+def open_calendar(path=DB_PATH, view=False):
+    """
+    Connect to the calendar at path, creating or upgrading it if needed, and load the config.
+    The calendar is opened read-only if view is True, or if another process holds the write lock.
+    """
+    global engine, connection, config, read_only, watcher, calendar_path, prefetcher, session_id
+    # Create the file if it doesn't exist
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    engine = create_engine(f'sqlite:///{path}', connect_args={'timeout': BUSY_TIMEOUT})
+    read_only = view or is_locked(engine)
+    if read_only:
+        if not os.path.exists(path):
+            print(f"There is no calendar at {path}. Exiting.")
             exit(1)
-    # if there is no other instance of calamity running, the database is corrupted
+        # readers never block the editor (nor wait for it) in WAL mode
+        engine.dispose()
+        engine = create_engine(f'sqlite:///file:{path}?mode=ro&uri=true', connect_args={'timeout': BUSY_TIMEOUT})
     else:
-        print( "Database is locked, but no other instance of calamity is running. Your database may be corrupted. Exiting.")
-        exit(1)
-
-# Create the tables if they don't exist
-Base.metadata.create_all(engine)
-
-# Create a session factory
-Session = sessionmaker(bind=engine)
-
-# Create globally shared config object
-default_config = {'military_time': False, 'timezone': 0, 'start_hour': 8, 'backup_location': '~/events_backup.db',
-                  'ROT13': False, 'show_help': True, 'color': 'cyan', 'check_lock': 0}
-config = ConfigDict(default_config)
+        # the journal mode is stored in the file, so viewers opened later use it too
+        with engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA journal_mode = WAL")
+        # Create the tables if they don't exist
+        Base.metadata.create_all(engine)
+        migrate(engine)
+    Session.configure(bind=engine)
+    connection = engine.connect()
+    session_id = Event.random_group_id()
+    if not read_only:
+        for statement in undo_log_triggers():
+            connection.exec_driver_sql(statement)
+        connection.commit()
+    watcher = DataWatcher(connection.connection.dbapi_connection)
+    # the cached days and the prefetcher's connection belong to the previous calendar, if any
+    if prefetcher is not None:
+        prefetcher.stop()
+    calendar_path, prefetcher = os.path.abspath(path), None
+    day_cache.clear()
+    # Create globally shared config object
+    config = state.config = ConfigDict(default_config)
+    return engine
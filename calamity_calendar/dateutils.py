@@ -8,6 +8,21 @@ def n_days_in_month(date: datetime.date):
     return (next_month - date).days
 
 
+def parse_free_slot(text):
+    """Parse 'minutes [HHMM-HHMM] [weekdays]' into (minutes, first time, last time, weekdays only)"""
+    minutes, *rest = text.split()
+    first_time, last_time, weekdays = 0, 24 * 60, False
+    for part in rest:
+        if part == 'weekdays':
+            weekdays = True
+        else:
+            first, last = (datetime.datetime.strptime(time, "%H%M") for time in part.split('-'))
+            first_time, last_time = first.hour * 60 + first.minute, last.hour * 60 + last.minute
+    if not 0 < int(minutes) <= last_time - first_time:
+        raise ValueError(text)
+    return int(minutes), first_time, last_time, weekdays
+
+
 def add_month(date: int, back=False):
     """Add a month to a given date (ordinal), keeping the day of the month the same if possible"""
     # get the number of days in this month n_days (e.g. 28 for Feb)
@@ -1,25 +1,53 @@
 import math
 import datetime
+import collections
 # to get the width of the terminal, use shutil.get_terminal_size().columns
 import shutil
 # import signal
 import wcwidth
 
-from calamity_calendar import colors, database
+from calamity_calendar import colors, state, cache, dateutils, profiler
 
 import sys
 from io import StringIO
 
 
 class Buffer(StringIO):
+    """
+    Collects a frame and draws it at the bottom of the terminal.
+    Only the lines that changed since the previous frame are rewritten.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.screen = None  # the lines on the screen (top to bottom), None if unknown
+
+    def invalidate(self):
+        # something else wrote to the terminal, so repaint everything next time
+        self.screen = None
+
     def flush(self):
-        print(self.getvalue(), end='', file=sys.stdout, flush=True)
+        height = get_term_height()
+        lines = ([''] * height + self.getvalue().split('\n'))[-height:]  # the frame is anchored to the bottom
+        out = colors.CURSOR_OFF + colors.WRAP_OFF
+        if self.screen is None or len(self.screen) != height:
+            out += '\n' * height + colors.CLEAR_SCREEN  # push the old contents into the scrollback
+            self.screen = [''] * height
+        for row, (old_line, line) in enumerate(zip(self.screen, lines)):
+            if line != old_line:
+                out += colors.CURSOR_TO.format(row=row + 1, column=1) + line + colors.CLEAR_LINE
+        out += colors.CURSOR_TO.format(row=height, column=1)
+        print(out, end='', file=sys.stdout, flush=True)
+        self.screen = lines
         self.truncate(0)  # Clear the current buffer
         self.seek(0)  # Reset the position
 
 
 buffer = Buffer()
 
+ROW_CACHE_SIZE = 512
+SHADES = [(0, '··'), (1, '░░'), (120, '▒▒'), (300, '▓▓'), (480, '██')]  # by booked minutes, for the overview
+OVERLAP_SYMBOL = '!'  # quarter hours booked by more than one appointment
 N_HOURS = 12
 TIMETABLE_WIDTH = N_HOURS * 4
 TABLE_WIDTH = 8 + TIMETABLE_WIDTH + 8 + 10 * 3 + 2
@@ -33,31 +61,34 @@ def get_num_days():
 
 
 def get_timetable_start():
-    return database.config['start_hour'] * 4
+    return state.config['start_hour'] * 4
 
 
 def get_timetable_end():
-    return (database.config['start_hour'] + N_HOURS) * 4
+    return (state.config['start_hour'] + N_HOURS) * 4
 
 
 def get_term_width():
     return shutil.get_terminal_size().columns
 
 
+def get_term_height():
+    return shutil.get_terminal_size().lines
+
+
 def get_margin():
     return ' ' * ((get_term_width() - TABLE_WIDTH) // 2)
 
 
 def get_timetable_header():
-    fill = '0' if database.config['military_time'] else ' '
-    nums = range(database.config['start_hour'], database.config['start_hour'] + N_HOURS)
-    if not database.config['military_time']:
+    fill = '0' if state.config['military_time'] else ' '
+    nums = range(state.config['start_hour'], state.config['start_hour'] + N_HOURS)
+    if not state.config['military_time']:
         nums = [(n - 1) % 12 + 1 for n in nums]
     return ' ' * 7 + '  '.join(str(n).rjust(2, fill) for n in nums) + ' ' * 3
 
 
 def welcome():
-    print('\n' * 100, file=buffer)  # clear the screen
     print(colors.ANSI_BOLD +
           "CAL-AMITY: Make friends with your timetable and avoid disaster.".center(get_term_width()) + '\n\n' +
           'Press ? for HELP.'.center(get_term_width()) + '\n' +
@@ -65,6 +96,10 @@ def welcome():
           file=buffer)
 
 
+def is_chosen(event, cal):
+    return cal.chosen_event is not None and event.key == cal.chosen_event.key
+
+
 def task_code(task, cal):
     assert task.type == "task"
     assert task.code is not None
@@ -72,7 +107,7 @@ def task_code(task, cal):
     prefix, suffix = colors.ANSI_REVERSE + colors.ANSI_COLOR_DICT.get(task.color, ''), colors.ANSI_RESET
     if task.date == cal.chosen_date:
         symbol = chr(ord('1') + cal.idx_of(task)) + ' '
-    if task is cal.chosen_event:
+    if is_chosen(task, cal):
         symbol = '**'
         prefix += colors.BOLD_ON
     code = conditional_rot13(task.code)
@@ -80,28 +115,33 @@ def task_code(task, cal):
 
 
 def tasks_row(date, cal):
-    return ' '.join(task_code(task, cal) for task in database.fetch_tasks(date, cal.session))
+    _, tasks, _ = cal.window[date]
+    return ' '.join(task_code(task, cal) for task in tasks)
 
 
 def timetable_row(date, cal):
-    appointments = database.fetch_appointments(date, cal.session)
+    appointments, _, _ = cal.window[date]
     row_selected = date == cal.chosen_date
     base_blocks = '▏   ' * (TIMETABLE_WIDTH // 4)
     blocks = [block for block in base_blocks]
+    taken = set()  # quarter hours already drawn, where a later appointment overlaps an earlier one
     for idx, appointment in enumerate(appointments):
         assert appointment.type == "appointment"
         start_quarter_hours = max(math.floor(appointment.start_time / 15) - get_timetable_start(), 0)
         end_quarter_hours = min(math.ceil(appointment.end_time / 15) - get_timetable_start(), TIMETABLE_WIDTH)
         if start_quarter_hours >= TIMETABLE_WIDTH or end_quarter_hours <= 0:
             continue
-        selected = appointment is cal.chosen_event
+        selected = is_chosen(appointment, cal)
         for i in range(start_quarter_hours, end_quarter_hours):
             symbol = base_blocks[i]
+            if i in taken:
+                symbol = OVERLAP_SYMBOL
             if selected:
                 symbol = '*'
             if row_selected and start_quarter_hours == i:
                 symbol = chr(ord('1') + idx)
             blocks[i] = symbol
+            taken.add(i)
         prefix = colors.ANSI_REVERSE + colors.ANSI_COLOR_DICT.get(appointment.color, '') + colors.BACKGROUND_COLOR_DICT[
             'white']
         if selected:
@@ -112,29 +152,37 @@ def timetable_row(date, cal):
 
 
 def chore_str(chore, cal):
-    symbol = '●'
-    if wcwidth.wcwidth(symbol) == 1:
-        symbol += ' '
-    selected = chore is cal.chosen_event
+    symbol = CHORE_SYMBOL
+    selected = is_chosen(chore, cal)
     return (colors.ANSI_COLOR_DICT.get(chore.color, '') +
             colors.ANSI_REVERSE * selected + symbol + colors.REVERSE_OFF * selected + colors.RESET_COLOR)
 
 
+# pad the chore symbol to two columns
+CHORE_SYMBOL = '●' + ' ' * (wcwidth.wcwidth('●') == 1)
+
+
 def chores_row(date, cal):
-    chores = database.fetch_chores(date, cal.session)
+    _, _, chores = cal.window[date]
     chores = [chore_str(chore, cal) for chore in chores]
     chores = ''.join(['  '] * (4 - len(chores)) + chores[3::-1])  # pad to 4 chores
     return chores
 
 
+# rendered (chores, appointments, tasks) strings, see day_row for the key
+row_cache = cache.LRUCache(ROW_CACHE_SIZE)
+
+
 def day_row(date, cal):
-    # pretty print
-    appointments = timetable_row(date, cal)
-    tasks = tasks_row(date, cal)
-    chores = chores_row(date, cal)
+    selected = date == cal.chosen_date
+    chosen = cal.chosen_event.key if cal.chosen_event and cal.chosen_event.date == date else None
+    key = (date, state.versions[date], selected, chosen, state.config.version)
+    if key not in row_cache:
+        # pretty print
+        row_cache[key] = chores_row(date, cal), timetable_row(date, cal), tasks_row(date, cal)
+    chores, appointments, tasks = row_cache[key]
     # get day of month from julian date
     day_of_month = datetime.date.fromordinal(date).day
-    selected = date == cal.chosen_date
     hotkey = chr(ord('A') + date - cal.from_date)
     hotkey = str(colors.ANSI_REVERSE) * selected + hotkey + str(colors.REVERSE_OFF) * selected
     return f"{chores}{appointments}▏ {day_of_month:>2}│{'*' if selected else ' '}{hotkey} │{tasks}{colors.RESET}"
@@ -151,6 +199,52 @@ def display_calendar(cal):
         print(get_margin() + day_row(date_num, cal), file=buffer)
 
 
+def overview_cell(date, totals, cal):
+    # shaded by the minutes booked that day, in the color with the most events
+    day = totals.get(date, {})
+    minutes = sum(booked for _, booked in day.values())
+    count = collections.Counter()
+    for (_, color), (n, _) in day.items():
+        count[color] += n
+    shade = ' ·' if not day else [symbol for threshold, symbol in SHADES if minutes >= threshold][-1]
+    prefix = colors.ANSI_COLOR_DICT.get(count.most_common(1)[0][0], '') if day else ''
+    if date == cal.chosen_date:
+        prefix += colors.ANSI_REVERSE
+    if date == cal.today:
+        prefix += colors.BOLD_ON
+    return ' ' + prefix + shade + colors.ANSI_RESET
+
+
+def display_overview(cal):
+    # the year of the chosen date, a month per row, with the totals of each month
+    year = datetime.date.fromordinal(cal.chosen_date).year
+    first, last = datetime.date(year, 1, 1).toordinal(), datetime.date(year + 1, 1, 1).toordinal()
+    from calamity_calendar import database  # not needed by the first frame, which is drawn without SQLAlchemy
+    totals = database.day_totals(first, last, cal.session)
+    print(get_margin() + colors.ANSI_BOLD + str(year).ljust(5) + colors.ANSI_RESET +
+          ''.join(str(day).rjust(3) for day in range(1, 32)) + '  events  hours', file=buffer)
+    for month in range(1, 13):
+        start = datetime.date(year, month, 1)
+        n_days = dateutils.n_days_in_month(start)
+        dates = range(start.toordinal(), start.toordinal() + n_days)
+        n_events = sum(n for date in dates for n, _ in totals.get(date, {}).values())
+        minutes = sum(booked for date in dates for _, booked in totals.get(date, {}).values())
+        print(get_margin() + start.strftime('%b').ljust(5) +
+              ''.join(overview_cell(date, totals, cal) for date in dates) + '   ' * (31 - n_days) +
+              f"{n_events:8} {minutes / 60:6.1f}", file=buffer)
+    # the totals of the chosen day, by type and color
+    day = totals.get(cal.chosen_date, {})
+    summary = []
+    for kind in ('appointment', 'task', 'chore'):
+        n = sum(count for (other, _), (count, _) in day.items() if other == kind)
+        minutes = sum(booked for (other, _), (_, booked) in day.items() if other == kind)
+        if n:
+            summary.append(f"{n} {kind}{'s' * (n > 1)}" + (f" ({minutes // 60}h{minutes % 60:02})" if minutes else ''))
+    print(file=buffer)
+    print(get_margin() + datetime.date.fromordinal(cal.chosen_date).strftime('%a %Y-%m-%d: ') +
+          (', '.join(summary) or 'nothing'), file=buffer)
+
+
 def show_days_events(cal):
     prev_type = None
     for i, event in enumerate(cal.events):
@@ -159,7 +253,7 @@ def show_days_events(cal):
             prev_type = event.type
         text = conditional_rot13(event.description or event.code)
         print(get_margin() + f"            {chr(ord('1') + i)}) "
-                             f"{colors.ANSI_COLOR_DICT[event.color]}{colors.ANSI_REVERSE * (event is cal.chosen_event)}"
+                             f"{colors.ANSI_COLOR_DICT[event.color]}{colors.ANSI_REVERSE * is_chosen(event, cal)}"
                              f"{text}"
                              f"{colors.ANSI_RESET}",
               file=buffer)
@@ -169,21 +263,39 @@ def show_days_events(cal):
 welcomed = False
 
 
+def invalidate():
+    # call before writing to the terminal outside of show_all (e.g. prompts)
+    print(colors.CLEAR_TO_END, end='')  # clear the message line for the prompt
+    buffer.invalidate()
+
+
 def show_all(cal):
-    print(colors.CLEAR_SCREEN + colors.CURSOR_OFF + colors.WRAP_OFF, end='', file=buffer)
     global welcomed
-    if welcomed:
-        show_days_events(cal)
-    elif not welcomed:
-        welcome()
-        welcomed = True
-    display_calendar(cal)
-    print(file=buffer)
-    for line in (lines := cal.message.splitlines()[:3]):
-        print(line.center(get_term_width()), file=buffer)
-    print('\n' * (3 - len(lines)), end='', file=buffer)
-    buffer.flush()  # print the buffer
-    print(colors.UP_LINE * 3 + colors.CLEAR_TO_END, end='')  # clear the last line when we next print
+    with profiler.stage('build'):
+        if welcomed:
+            show_days_events(cal)
+        elif not welcomed:
+            welcome()
+            welcomed = True
+        if cal.overview:
+            display_overview(cal)
+        else:
+            display_calendar(cal)
+        print(file=buffer)
+        for line in (lines := cal.message.splitlines()[:3]):
+            print(line.center(get_term_width()), file=buffer)
+        print('\n' * (3 - len(lines)), end='', file=buffer)
+    with profiler.stage('flush'):
+        buffer.flush()  # print the buffer
+        print(colors.UP_LINE * 3, end='', flush=True)  # prompts are printed over the message lines
+
+
+def show_overlay(text):
+    # drawn over the top line of the terminal, which the next frame repaints
+    print(colors.SAVE_CURSOR + colors.CURSOR_TO.format(row=1, column=1) + colors.ANSI_REVERSE + text +
+          colors.ANSI_RESET + colors.CLEAR_LINE + colors.RESTORE_CURSOR, end='', flush=True)
+    if buffer.screen:
+        buffer.screen[0] = None
 
 
 rot13_trans = str.maketrans(
@@ -199,4 +311,4 @@ def rot13(text):
 
 def conditional_rot13(text):
     # Do ROT13 if the config says so
-    return rot13(text) if database.config['ROT13'] else text
+    return rot13(text) if state.config['ROT13'] else text
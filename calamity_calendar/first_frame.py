@@ -0,0 +1,62 @@
+"""
+The first frame, drawn with sqlite3 as soon as calamity starts. Importing the application (and SQLAlchemy) and opening
+the calendar take a few hundred milliseconds more; the frame the application draws then only rewrites the lines that
+changed (the welcome message is replaced by the events of the day).
+"""
+import datetime
+import json
+import os
+import sqlite3
+
+from calamity_calendar import agenda, display, getch, state
+
+# in the order of database.query_window
+EVENTS_ORDER_SQL = agenda.EVENTS_SQL + " ORDER BY date, start_time, id"
+
+
+class Config(dict):
+    # the decoded config table, read-only
+    version = 0  # part of the key of the rendered rows
+
+
+class Calendar:
+    """The attributes of app.Calamity that display.show_all reads: today is chosen, at the top of the window."""
+
+    def __init__(self, window):
+        self.today = self.chosen_date = self.from_date = datetime.date.today().toordinal()
+        self.window = window
+        self.appointments, self.tasks, self.chores = window[self.chosen_date]
+        self.events = self.appointments + self.tasks + self.chores
+        self.chosen_event = None
+        self.overview = False
+        self.message = ''
+
+    def idx_of(self, event):
+        return [other.key for other in self.events].index(event.key)
+
+
+def show(path=agenda.DB_PATH):
+    # draws nothing if there is no calendar yet, or if it can't be read right away (locked, or an older version)
+    if not os.path.exists(path):
+        return
+    today = datetime.date.today().toordinal()
+    n_days = display.get_num_days()
+    params = {'from_date': today, 'to_date': today + n_days}
+    try:
+        connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=0)
+        try:
+            config = dict(state.default_config)
+            config.update((key, json.loads(value)) for key, value in connection.execute("SELECT key, value FROM config"))
+            rows = connection.execute(EVENTS_ORDER_SQL, params).fetchall()
+            rows += connection.execute(agenda.OCCURRENCES_SQL + " ORDER BY rules.id", params).fetchall()
+        finally:
+            connection.close()
+    except (sqlite3.Error, ValueError):
+        return
+    getch.raw_mode()  # keys typed from now on are not echoed over the frame
+    state.config = Config(config)
+    display.show_all(Calendar(state.make_window(today, n_days, rows)))
+    # the calendar may change before the application opens it, and the rows would be reused
+    display.row_cache.clear()
+    state.config = None
+
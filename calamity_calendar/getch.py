@@ -1,7 +1,16 @@
 """
-Get a single character from stdin, without waiting for a newline.
-If the terminal is resized, getch() will return None.
+Read the keys typed in the terminal, without waiting for a newline.
+The terminal stays in raw mode (output processing is kept, so '\n' still starts a new line) from the first getch() until
+the program exits. Whatever was typed is read at once into a queue, so that a burst of keys (a held key, a paste) can be
+dispatched before the next frame is drawn: pending() tells whether more keys are waiting.
+If the terminal is resized, getch() will return 'RESIZE'.
+If idle is given, it is called every timeout seconds while waiting, and getch() returns 'REFRESH' when it returns True.
 """
+import atexit
+import codecs
+import collections
+import contextlib
+import importlib
 import sys
 import tty
 import termios
@@ -12,23 +21,93 @@ import signal
 import select
 
 read_fd, write_fd = os.pipe()
+queue = collections.deque()  # the keys read but not handed out yet
+decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')  # a burst may end in the middle of a character
+saved_settings = None  # the settings of the terminal before raw mode
+terminal_fd = None  # kept, as exit() closes sys.stdin before the settings are restored
+prompt_input = None  # prompt_toolkit's input, which holds its typeahead
+READ_SIZE = 1024
 
 def handle_winch(signum, frame):
     os.write(write_fd, b'x')
 
 signal.signal(signal.SIGWINCH, handle_winch)
 
-def getch():
+def raw_mode():
+    global saved_settings, terminal_fd
     fd = sys.stdin.fileno()
-    old_settings = termios.tcgetattr(fd)
+    if saved_settings is not None or not os.isatty(fd):
+        return
+    terminal_fd, saved_settings = fd, termios.tcgetattr(fd)
+    tty.setraw(fd)
+    settings = termios.tcgetattr(fd)
+    settings[1] = saved_settings[1]  # output flags
+    termios.tcsetattr(fd, termios.TCSADRAIN, settings)
+    atexit.register(restore)
+
+def restore():
+    global saved_settings
+    if saved_settings is not None:
+        termios.tcsetattr(terminal_fd, termios.TCSADRAIN, saved_settings)
+        saved_settings = None
+
+def read(timeout):
+    # wait up to timeout seconds for input, then queue all of it, returns False on timeout
+    r, _, _ = select.select([sys.stdin, read_fd], [], [], timeout)
+    if sys.stdin in r:
+        queue.extend(decoder.decode(os.read(sys.stdin.fileno(), READ_SIZE)))
+    if read_fd in r:
+        os.read(read_fd, READ_SIZE)
+        queue.append('RESIZE')
+    return bool(r)
+
+def pending():
+    # whether keys are waiting, queueing those typed since the last read (without waiting)
+    if not queue:
+        raw_mode()
+        read(0)
+    return bool(queue)
+
+def getch(timeout=None, idle=None):
+    raw_mode()
+    while not queue:
+        if read(timeout):
+            continue
+        if saved_settings is not None and prompt_input is None:
+            load_prompt_toolkit()
+        if idle is not None and idle():
+            return 'REFRESH'
+    return queue.popleft()
+
+def load_prompt_toolkit():
+    # takes a fifth of a second, so it is done while waiting for a key, or after the first prompt
+    global prompt_input
+    from prompt_toolkit.input import create_input
+    # warm the import cache for typeahead(), so that lending keys to the first prompt doesn't wait on the imports
+    importlib.import_module('prompt_toolkit.input.typeahead')
+    importlib.import_module('prompt_toolkit.input.vt100_parser')
+    prompt_input = create_input()
+
+@contextlib.contextmanager
+def typeahead():
+    """
+    Lend the queued keys to the prompts opened in the block: prompt_toolkit keeps the keys it read too early as
+    typeahead for its next prompt. The keys the prompts didn't use (or read after them) are queued again, in front.
+    """
+    if prompt_input is not None and queue:
+        from prompt_toolkit.input.typeahead import store_typeahead
+        from prompt_toolkit.input.vt100_parser import Vt100Parser
+        keys = []
+        parser = Vt100Parser(keys.append)
+        parser.feed(''.join(queue))
+        parser.flush()
+        queue.clear()
+        store_typeahead(prompt_input, keys)
     try:
-        tty.setraw(sys.stdin.fileno())
-        r, _, _ = select.select([sys.stdin, read_fd], [], [])
-        if sys.stdin in r:
-            ch = sys.stdin.read(1)
-        elif read_fd in r:
-            os.read(read_fd, 1)
-            ch = 'RESIZE'
+        yield
     finally:
-        termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
-    return ch
+        if saved_settings is not None and 'prompt_toolkit' in sys.modules:
+            from prompt_toolkit.input.typeahead import get_typeahead
+            if prompt_input is None:
+                load_prompt_toolkit()
+            queue.extendleft(reversed(''.join(key.data for key in get_typeahead(prompt_input))))
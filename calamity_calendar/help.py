@@ -35,11 +35,13 @@ HELP_TEXT = """\
 │ >) Next month             │   ,) Cycle color backwards              │  z0) Toggle 12/24 hour        │
 │ b) Previous week          │   +) Postpone one day                   │  z?) Toggle help visibility   │
 │ w) Next week              │   -) Prepone one day                    │  g?) Toggle ROT13 encryption  │
-│ TAB) Next chore           │   x) Delete event                       │                               │
-│ SPC) Next appointment     │   r) Repeat event                       ├─────────── Undo ──────────────┤
-│ RET) Next task            │   m) Move event                         │  u) Undo                      │
-│ gg) Jump to today         │   ~) Toggle chore / task                │  CTRL-R) Redo                 │
-│                           │   gX) Kill future repetitions           │  .) Repeat last action        │
+│ TAB) Next chore           │   x) Delete event                       │  zm) Memory usage             │
+│ SPC) Next appointment     │   r) Repeat event                       │  zo) Year overview            │
+│ RET) Next task            │   m) Move event                         │  zr) Time report              │
+│ gg) Jump to today         │   ~) Toggle chore / task                ├─────────── Undo ──────────────┤
+│ f) Next free slot         │   gX) Kill future repetitions           │  u) Undo                      │
+│                           │                                         │  CTRL-R) Redo                 │
+│                           │                                         │  .) Repeat last action        │
 ├───────────────────────────┴─────────────────────────────────────────┴───────────────────────────────┤
 │                                                                                                     │
 │      ANY EDIT COMMAND CAN BE GIVEN THE PREFIX [g] TO APPLY TO THE ENTIRE REPETITION GROUP           │
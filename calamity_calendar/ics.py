@@ -0,0 +1,358 @@
+"""
+Import and export of iCalendar (.ics) files, streamed so that large calendars take constant memory.
+Appointments are timed events, tasks and chores are all-day events, and recurrence rules become RRULEs.
+Daily and weekly RRULEs are imported as rules, monthly and yearly ones are expanded into events.
+Calamity's own fields are kept in X-CALAMITY- properties, so they survive a round trip.
+"""
+import datetime
+import re
+import zlib
+import zoneinfo
+
+import sqlalchemy
+
+from calamity_calendar import colors, database
+from calamity_calendar.database import Event, Rule, RuleException
+
+BATCH_SIZE = 1000  # rows fetched, or inserted, at a time
+MAX_LINE = 75  # octets, longer lines are folded
+OPEN_ENDED_YEARS = 5  # rules without a COUNT or an UNTIL are imported for this many years
+WEEKDAYS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+END_OF_DAY = 24 * 60
+
+
+# EXPORT
+def escape(text):
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def fold(line):
+    # lines longer than MAX_LINE octets are continued on the next line, which starts with a space
+    if len(line.encode()) <= MAX_LINE:
+        return line + '\r\n'
+    chunks, chunk, size = [], '', 0
+    for char in line:
+        if size + len(char.encode()) > MAX_LINE:
+            chunks.append(chunk)
+            chunk, size = ' ', 1
+        chunk += char
+        size += len(char.encode())
+    return '\r\n'.join(chunks + [chunk]) + '\r\n'
+
+
+def format_date(date):
+    return datetime.date.fromordinal(date).strftime('%Y%m%d')
+
+
+def format_time(date, minutes):
+    date, minutes = date + minutes // END_OF_DAY, minutes % END_OF_DAY  # the end of the day is midnight of the next
+    return f"{format_date(date)}T{minutes // 60:02}{minutes % 60:02}00"
+
+
+def component(row, uid, stamp, rrule=None, exceptions=()):
+    # a VEVENT for a row of the events table, or of the rules table (with its RRULE and exception dates)
+    date, start, end = row['date'], row['start_time'], row['end_time']
+    timed = row['type'] == 'appointment' and start is not None and end is not None
+    lines = ['BEGIN:VEVENT', f'UID:{uid}', f'DTSTAMP:{stamp}']
+    if timed:
+        lines += [f'DTSTART:{format_time(date, start)}', f'DTEND:{format_time(date, end)}']
+    else:
+        lines += [f'DTSTART;VALUE=DATE:{format_date(date)}']
+    if rrule:
+        lines.append(f'RRULE:{rrule}')
+    if exceptions:
+        dates = ','.join(format_time(date, start) if timed else format_date(date) for date in exceptions)
+        lines.append(f'EXDATE:{dates}' if timed else f'EXDATE;VALUE=DATE:{dates}')
+    lines += [f'SUMMARY:{escape(row["description"] or "")}', f'X-CALAMITY-TYPE:{row["type"]}',
+              f'X-CALAMITY-GROUP:{row["recurrence_parent"]}']
+    if row['color']:
+        lines.append(f'COLOR:{row["color"]}')
+    if row['code']:
+        lines.append(f'X-CALAMITY-CODE:{escape(row["code"])}')
+    lines.append('END:VEVENT')
+    return ''.join(fold(line) for line in lines)
+
+
+def export(file, session, from_date=None, to_date=None):
+    """
+    Write the events (and rule occurrences) from from_date to to_date (inclusive, None for no limit) to file.
+    Returns the number of VEVENTs written.
+    """
+    from_date = from_date if from_date is not None else 0
+    to_date = to_date if to_date is not None else datetime.date.max.toordinal()
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    file.write('BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//calamity//calamity_calendar//EN\r\n')
+    n = 0
+    events = sqlalchemy.select(*Event.__table__.columns).where(
+        Event.date >= from_date, Event.date <= to_date).order_by(Event.date)
+    for row in session.execute(events.execution_options(yield_per=BATCH_SIZE)):
+        file.write(component(row._mapping, f'event-{row.id}@calamity', stamp))
+        n += 1
+    # the rules which occur in the range, with their exception dates
+    last_date = Rule.date + (Rule.count - 1) * Rule.period
+    exceptions = sqlalchemy.func.group_concat(RuleException.date).label('exceptions')
+    rules = sqlalchemy.select(*Rule.__table__.columns, exceptions).outerjoin(
+        RuleException, RuleException.rule_id == Rule.id).where(Rule.date <= to_date, last_date >= from_date).group_by(
+        Rule.id)
+    for row in session.execute(rules.execution_options(yield_per=BATCH_SIZE)):
+        # only the occurrences in the range are exported
+        first = max(0, -((row.date - from_date) // row.period))  # index of the first occurrence on or after from_date
+        last = min(row.count - 1, (to_date - row.date) // row.period)
+        if first > last:
+            continue
+        rule = dict(row._mapping, date=row.date + first * row.period)
+        exceptions = sorted(int(date) for date in (row.exceptions or '').split(',') if date)
+        exceptions = [date for date in exceptions if rule['date'] <= date <= to_date]
+        file.write(component(rule, f'rule-{row.id}@calamity', stamp,
+                             rrule=f'FREQ=DAILY;INTERVAL={row.period};COUNT={last - first + 1}', exceptions=exceptions))
+        n += 1
+    file.write('END:VCALENDAR\r\n')
+    return n
+
+
+# IMPORT
+def unescape(text):
+    return re.sub(r'\\(.)', lambda match: '\n' if match.group(1) in 'nN' else match.group(1), text)
+
+
+def unfold(lines):
+    # join the continuation lines (starting with a space or a tab) to the line they continue
+    previous = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and previous is not None:
+            previous += line[1:]
+            continue
+        if previous:
+            yield previous
+        previous = line
+    if previous:
+        yield previous
+
+
+def parse_line(line):
+    # NAME;PARAM=VALUE;...:VALUE, where a quoted parameter value may contain a colon
+    colon = line.find(':')
+    if colon < 0:
+        return '', {}, ''
+    if '"' in line[:colon]:
+        quoted = False
+        for colon, char in enumerate(line):
+            if char == '"':
+                quoted = not quoted
+            elif char == ':' and not quoted:
+                break
+    head, value = line[:colon], line[colon + 1:]
+    name, *params = head.split(';')
+    params = dict(param.partition('=')[::2] for param in params)
+    return name.upper(), params, value
+
+
+def read_events(lines):
+    # the VEVENTs of an iCalendar file as {name: (params, value)} dicts, with the list of their EXDATEs
+    event, nested = None, 0
+    for line in unfold(lines):
+        name, params, value = parse_line(line)
+        if event is None:
+            if name == 'BEGIN' and value.upper() == 'VEVENT':
+                event = {'EXDATE': []}
+        elif name == 'BEGIN':
+            nested += 1  # e.g. a VALARM, whose properties are not the event's
+        elif name == 'END' and nested:
+            nested -= 1
+        elif name == 'END':
+            yield event
+            event = None
+        elif nested:
+            continue
+        elif name == 'EXDATE':
+            event['EXDATE'] += [(params, date) for date in value.split(',')]
+        elif name not in event:
+            event[name] = (params, value)
+
+
+def parse_datetime(params, value):
+    # returns the date (as an ordinal) and the time (in minutes since midnight, None for a date), in local time
+    # sliced rather than strptime'd, which is several times slower
+    date = datetime.date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+    if params.get('VALUE') == 'DATE' or len(value) == 8:
+        return date.toordinal(), None
+    moment = datetime.datetime(date.year, date.month, date.day, int(value[9:11]), int(value[11:13]))
+    if value.endswith('Z'):
+        moment = moment.replace(tzinfo=datetime.timezone.utc).astimezone().replace(tzinfo=None)
+    elif 'TZID' in params:
+        try:
+            zone = zoneinfo.ZoneInfo(params['TZID'].strip('"'))
+            moment = moment.replace(tzinfo=zone).astimezone().replace(tzinfo=None)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            pass  # an unknown time zone, e.g. a Windows name: keep the time as it is
+    return moment.toordinal(), moment.hour * 60 + moment.minute
+
+
+def parse_duration(value):
+    # in minutes, e.g. PT1H30M
+    match = re.fullmatch(r'[+]?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?', value)
+    if not match:
+        return 0
+    weeks, days, hours, minutes, _ = (int(part or 0) for part in match.groups())
+    return ((weeks * 7 + days) * 24 + hours) * 60 + minutes
+
+
+def to_row(event):
+    # the event dict (see Event) for a VEVENT
+    date, start = parse_datetime(*event['DTSTART'])
+    kind = event.get('X-CALAMITY-TYPE', ({}, ''))[1]
+    row = {'date': date, 'description': unescape(event.get('SUMMARY', ({}, ''))[1]),
+           'code': unescape(event.get('X-CALAMITY-CODE', ({}, ''))[1]),
+           'type': kind if kind in ('task', 'chore') else 'chore', 'start_time': None, 'end_time': None}
+    if start is not None:
+        if 'DTEND' in event:
+            end_date, end = parse_datetime(*event['DTEND'])
+            end = END_OF_DAY if end is None or end_date > date else end
+        else:
+            end = min(start + parse_duration(event.get('DURATION', ({}, ''))[1]), END_OF_DAY)
+        row.update(type='appointment', start_time=start, end_time=max(end, start))
+    color = event.get('COLOR', ({}, ''))[1].lower()
+    if color not in colors.COLORS:
+        # cycle to the next color, like a new event
+        color = database.config['color'] = colors.CYCLE_DICT[database.config['color']]
+    row['color'] = color
+    # the events of a recurrence group share their UID (a recurring event and its modified occurrences)
+    group = event.get('X-CALAMITY-GROUP', ({}, ''))[1]
+    uid = event.get('UID', ({}, ''))[1]
+    row['recurrence_parent'] = int(group) if group.isdigit() else zlib.crc32(uid.encode()) if uid else \
+        Event.random_group_id()
+    return row
+
+
+def nth_weekday(year, month, weekday, n):
+    # the date of the nth (counting from the end if negative) weekday of a month, None if there is none
+    first = datetime.date(year, month, 1)
+    n_days = (datetime.date(year + month // 12, month % 12 + 1, 1) - first).days
+    days = [day for day in range(1, n_days + 1) if (first.weekday() + day - 1) % 7 == weekday]
+    if not n or abs(n) > len(days):
+        return None
+    return datetime.date(year, month, days[n - 1 if n > 0 else n]).toordinal()
+
+
+def expand(rule, date, until, count):
+    # the dates of a MONTHLY or YEARLY rule, which can't be stored as a rule (its period is not a number of days)
+    start, interval = datetime.date.fromordinal(date), int(rule.get('INTERVAL', 1))
+    months = interval * (12 if rule['FREQ'] == 'YEARLY' else 1)
+    byday = re.fullmatch(r'([+-]?\d+)(MO|TU|WE|TH|FR|SA|SU)', rule.get('BYDAY', ''))
+    day = int(rule.get('BYMONTHDAY', start.day))
+    n, i = 0, 0
+    while n < count:
+        month = start.month - 1 + i * months
+        year, month = start.year + month // 12, month % 12 + 1
+        if year > datetime.MAXYEAR:
+            break
+        if byday and rule['FREQ'] == 'MONTHLY':
+            occurrence = nth_weekday(year, month, WEEKDAYS.index(byday.group(2)), int(byday.group(1)))
+        else:
+            try:
+                occurrence = datetime.date(year, month, day).toordinal()
+            except ValueError:
+                occurrence = None  # e.g. the 31st of a short month
+        i += 1
+        if occurrence is None or occurrence < date:
+            continue
+        if occurrence > until:
+            break
+        yield occurrence
+        n += 1
+
+
+def recurrence(event, row):
+    # the rule dicts (for DAILY and WEEKLY rules) and the dates of the other occurrences (expanded rules)
+    rule = dict(part.partition('=')[::2] for part in event['RRULE'][1].upper().split(';'))
+    until = parse_datetime({}, rule['UNTIL'])[0] if 'UNTIL' in rule else None
+    count = int(rule['COUNT']) if 'COUNT' in rule else None
+    if until is None and count is None:
+        until = row['date'] + OPEN_ENDED_YEARS * 365
+    exceptions = {parse_datetime(*exdate)[0] for exdate in event['EXDATE']}
+    if rule.get('FREQ') in ('DAILY', 'WEEKLY'):
+        period = int(rule.get('INTERVAL', 1)) * (7 if rule['FREQ'] == 'WEEKLY' else 1)
+        starts = [row['date']]
+        if rule['FREQ'] == 'WEEKLY' and rule.get('BYDAY'):
+            # a rule for each day of the week, starting on the first such day on or after DTSTART
+            weekdays = [WEEKDAYS.index(day[-2:]) for day in rule['BYDAY'].split(',') if day[-2:] in WEEKDAYS]
+            starts = sorted(row['date'] + (weekday - datetime.date.fromordinal(row['date']).weekday()) % 7
+                            for weekday in set(weekdays)) or starts
+        rules = []
+        for k, start in enumerate(starts):
+            # the occurrences alternate between the days of the week, so COUNT is shared between the rules
+            n = (count - k + len(starts) - 1) // len(starts) if count is not None else (until - start) // period + 1
+            if until is not None:
+                n = min(n, (until - start) // period + 1)
+            if n > 0:
+                rules.append(dict(row, date=start, period=period, count=n, exceptions=sorted(
+                    date for date in exceptions if (date - start) % period == 0 and 0 <= date - start < n * period)))
+        return rules, []
+    if rule.get('FREQ') in ('MONTHLY', 'YEARLY'):
+        dates = expand(rule, row['date'], until if until is not None else datetime.date.max.toordinal(),
+                       count if count is not None else float('inf'))
+        return [], [date for date in dates if date != row['date'] and date not in exceptions]
+    return [], []  # e.g. an HOURLY rule: only the first occurrence
+
+
+def import_(file, session):
+    """
+    Add the VEVENTs of an iCalendar file to the calendar, reading it line by line and inserting in batches.
+    Returns the number of events and rules added.
+    """
+    events, rules = [], []
+    overrides = []  # (index in events, recurrence_parent, date) of the events replacing an occurrence (RECURRENCE-ID)
+    replaced = []  # (id of the event, recurrence_parent, date) of those, once inserted (no id for a split series)
+    n_events = n_rules = 0
+
+    def insert(final=False):
+        nonlocal events, rules, overrides
+        if len(events) >= BATCH_SIZE or final:
+            if events and not overrides:
+                # the ids are only needed for the overrides: without RETURNING, the batch is a single executemany
+                session.execute(sqlalchemy.insert(Event), events)
+            elif events:
+                ids = database.insert_events(events, session)
+                replaced.extend((ids[i], recurrence_parent, date) for i, recurrence_parent, date in overrides)
+            events, overrides = [], []
+        if len(rules) >= BATCH_SIZE or final:
+            database.insert_rules(rules, session)
+            rules = []
+
+    for event in read_events(file):
+        if 'DTSTART' not in event:
+            continue
+        row = to_row(event)
+        if 'RECURRENCE-ID' in event:
+            date = parse_datetime(*event['RECURRENCE-ID'])[0]
+            if 'RRULE' in event:
+                # a series split off the recurring event (RANGE=THISANDFUTURE) is a group of its own, whose first
+                # occurrence replaces the one of the recurring event
+                replaced.append((None, row['recurrence_parent'], date))
+                row['recurrence_parent'] = zlib.crc32(f"{event.get('UID', ({}, ''))[1]} {date}".encode())
+            else:
+                overrides.append((len(events), row['recurrence_parent'], date))
+        if 'RRULE' in event:
+            new_rules, dates = recurrence(event, row)
+            rules += new_rules
+            events += [dict(row, date=date) for date in dates]
+            n_rules += len(new_rules)
+            n_events += len(dates)
+            if new_rules:
+                insert()
+                continue  # the first occurrence is an occurrence of the rule
+        events.append(row)
+        n_events += 1
+        insert()
+    insert(final=True)
+    # the replaced occurrences are hidden (rules) or deleted (expanded rules)
+    for event_id, recurrence_parent, date in replaced:
+        params = {'id': event_id, 'rp': recurrence_parent, 'date': date}
+        session.execute(sqlalchemy.text(
+            "INSERT OR IGNORE INTO rule_exceptions (rule_id, date) SELECT id, :date FROM rules "
+            "WHERE recurrence_parent = :rp AND :date >= date AND (:date - date) % period = 0 "
+            "AND (:date - date) / period < count"), params)
+        session.execute(sqlalchemy.text(
+            "DELETE FROM events WHERE recurrence_parent = :rp AND date = :date AND id IS NOT :id"), params)
+    return n_events, n_rules
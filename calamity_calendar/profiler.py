@@ -0,0 +1,73 @@
+"""
+Opt-in timing of the stages of each frame, enabled with the CALAMITY_PROFILE environment variable:
+    CALAMITY_PROFILE=1 calamity             shows the timings of the last frame on the top line of the terminal
+    CALAMITY_PROFILE=frames.jsonl calamity  also appends them to frames.jsonl, one JSON object per frame
+A frame is the dispatch of the commands typed since the last one (a burst of keys is drawn once), including the time
+spent in their prompts, the refresh of the data, building the frame and flushing it to the terminal.
+SQL statements are counted with a SQLAlchemy event hook. When disabled, stage() hands out a shared no-op context
+manager, so the instrumentation costs a function call per stage.
+"""
+import contextlib
+import json
+import time
+
+STAGES = ('dispatch', 'refresh', 'build', 'flush')
+
+enabled = False
+log = None  # the JSONL file, if any
+frame = {}  # {stage: seconds} for the current frame
+keys = ''  # the keys dispatched in the current frame
+n_statements = 0
+NULL = contextlib.nullcontext()
+
+
+class Stage:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        frame[self.name] = frame.get(self.name, 0) + time.perf_counter() - self.start
+
+
+def enable(setting):
+    # setting is the value of CALAMITY_PROFILE: a file name for the log, or any other true value for the overlay only
+    global enabled, log
+    import sqlalchemy
+    enabled = True
+    if setting.endswith('.jsonl'):
+        log = open(setting, 'a', buffering=1)
+    sqlalchemy.event.listen(sqlalchemy.engine.Engine, 'before_cursor_execute', count_statement)
+
+
+def count_statement(*args):
+    global n_statements
+    n_statements += 1
+
+
+def stage(name):
+    return Stage(name) if enabled else NULL
+
+
+def key(c):
+    global keys
+    if enabled:
+        keys += c
+
+
+def end_frame():
+    # log the frame, returns the text of the overlay (None when disabled)
+    global frame, keys, n_statements
+    if not enabled:
+        return None
+    times = {name: round(frame.get(name, 0) * 1000, 3) for name in STAGES}
+    if log is not None:
+        log.write(json.dumps({'time': time.time(), 'keys': keys, **times, 'total': round(sum(times.values()), 3),
+                              'sql': n_statements}) + '\n')
+    overlay = ' '.join(f"{name} {ms:.1f}" for name, ms in times.items())
+    overlay = f" {overlay} | total {sum(times.values()):.1f} ms | {n_statements} SQL "
+    frame, keys, n_statements = {}, '', 0
+    return overlay
@@ -0,0 +1,71 @@
+"""
+What the frames are drawn from, without SQLAlchemy: the config of the calendar, the versions of its dates and the rows
+of events. database.open_calendar sets them up for the application; the first frame is drawn from them (see
+first_frame) before the application and SQLAlchemy are imported.
+"""
+import collections
+import itertools
+
+# the columns of the events table
+EVENT_FIELDS = ['id', 'date', 'description', 'color', 'recurrence_parent', 'type', 'start_time', 'end_time', 'code']
+
+default_config = {'military_time': False, 'timezone': 0, 'start_hour': 8, 'backup_location': '~/events_backup.db',
+                  'backup_snapshots': 0,
+                  'ROT13': False, 'show_help': True, 'color': 'cyan',
+                  'session_margin': 31, 'undo_depth': 1000}
+
+config = None  # the database.ConfigDict of the calendar, set by database.open_calendar (or first_frame.show)
+
+
+class EventView(collections.namedtuple('EventView', EVENT_FIELDS + ['rule_id'], defaults=[None])):
+    """
+    A read-only row of the events table, or an occurrence of a rule (then id is None and rule_id is set).
+    The render path uses these instead of Event instances; an Event is only loaded to modify it.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_event(cls, event):
+        return cls(*(getattr(event, key) for key in EVENT_FIELDS))
+
+    @property
+    def key(self):
+        # identifies the event, or the occurrence, across fetches
+        return self.id if self.rule_id is None else (self.rule_id, self.date)
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in EVENT_FIELDS}
+
+
+def make_window(from_date, n_days, rows):
+    # {date: (appointments, tasks, chores)} of the rows of events, appointments by start time
+    window = {date: ([], [], []) for date in range(from_date, from_date + n_days)}
+    slots = {'appointment': 0, 'task': 1, 'chore': 2}
+    for event in itertools.starmap(EventView, rows):
+        window[event.date][slots[event.type]].append(event)
+    for appointments, _, _ in window.values():
+        appointments.sort(key=lambda event: (event.start_time is not None, event.start_time or 0))
+    return window
+
+
+class DataVersions:
+    """
+    Version numbers for the events on each date, used to invalidate render caches.
+    A date's version changes whenever a flush or a bulk statement may have changed its events.
+    """
+
+    def __init__(self):
+        self.generation = 0  # bumped by changes that may touch any date (bulk updates, undo)
+        self.dates = collections.Counter()
+
+    def touch(self, date):
+        self.dates[date] += 1
+
+    def touch_all(self):
+        self.generation += 1
+
+    def __getitem__(self, date):
+        return self.generation, self.dates[date]
+
+
+versions = DataVersions()
@@ -2,6 +2,8 @@ import datetime
 
 from questionary import Validator, ValidationError
 
+from calamity_calendar import agenda, dateutils
+
 
 class DateValidator(Validator):
     def validate(self, document):
@@ -42,4 +44,26 @@ class RepetitionValidator(Validator):
             raise ValidationError(
                 message="Please enter a valid repetition (period+repetitions)",
                 cursor_position=len(document.text),
-            )
\ No newline at end of file
+            )
+
+
+class FreeSlotValidator(Validator):
+    def validate(self, document):
+        try:
+            dateutils.parse_free_slot(document.text)
+        except ValueError:
+            raise ValidationError(
+                message="Please enter minutes, optionally hours (HHMM-HHMM) and weekdays, e.g. 60 0900-1700 weekdays",
+                cursor_position=len(document.text),
+            )
+
+
+class ReportValidator(Validator):
+    def validate(self, document):
+        try:
+            agenda.parse_report(document.text)
+        except ValueError:
+            raise ValidationError(
+                message="Please enter columns (color, code, type, group) and a period (week, month, all)",
+                cursor_position=len(document.text),
+            )